@@ -1,4 +1,6 @@
 import sys
+import time
+import signal
 import subprocess
 import threading
 
@@ -9,6 +11,11 @@ except ImportError:
 
 ON_POSIX = 'posix' in sys.builtin_module_names
 
+class _StampedQueue (Queue):
+    """ Remembers when each item was put, see [AsyncPipe.received_at]. """
+    def put(self, item, block=True, timeout=None):
+        Queue.put(self, (time.time(), item), block, timeout)
+
 class AsyncPipe (object):
     def __init__(self, subprocess_kwargs, parser):
         """Wraps a subprocess and thread reading from it
@@ -19,9 +26,14 @@ class AsyncPipe (object):
         """
         self.proc = subprocess.Popen(stdin=subprocess.PIPE,
                                      stdout=subprocess.PIPE,
-                                     bufsize=1, close_fds=ON_POSIX,
+                                     bufsize=-1, close_fds=ON_POSIX,
                                      **subprocess_kwargs)
-        self.queue = Queue()
+        self.queue = _StampedQueue()
+        #: What was written since the last [flush].
+        self._unflushed = []
+        #: When the reader thread got the last item returned by [get], i.e.
+        #: before it waited for vim to process it.
+        self.received_at = None
         self.io_thread = threading.Thread(
             target=parser,
             args=(self.proc.stdout, self.queue))
@@ -29,16 +41,97 @@ class AsyncPipe (object):
         self.io_thread.daemon = True # thread dies with the program
         self.io_thread.start()
 
-    def close(self):
-        # TODO add threading.Event and have things die
-        self.proc.terminate()
+    def close(self, quit=None, timeout=1.0):
+        """
+        Stops the process, waits for it and for the reader thread, and closes
+        the pipes.
+
+        The process is first asked to exit by itself: [quit] is written to it
+        (if given) and its stdin is closed. If it is still running [timeout]
+        seconds later it is terminated, and killed after as many again.
+        """
+        proc = self.proc
+        if proc.poll() is None:
+            try:
+                if quit is not None:
+                    self.write(quit)
+                self.flush()
+                proc.stdin.close()
+            except (IOError, OSError, ValueError):
+                # It died in the meantime.
+                pass
+            if not self._wait(timeout):
+                proc.terminate()
+                if not self._wait(timeout):
+                    proc.kill()
+                    proc.wait()
+        # Once the process is gone the reader thread hits the end of its
+        # stdout and stops: its pipe can only be closed after that.
+        self.io_thread.join(timeout)
+        for pipe in (proc.stdin, proc.stdout):
+            if pipe is proc.stdout and self.io_thread.is_alive():
+                continue
+            try:
+                pipe.close()
+            except (IOError, OSError, ValueError):
+                pass
+
+    def _wait(self, timeout):
+        """ Waits for the process to exit. Returns False if it didn't. """
+        deadline = time.time() + timeout
+        while self.proc.poll() is None:
+            if time.time() > deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def interrupt(self):
+        # Once the process is reaped its pid may belong to someone else.
+        if self.proc.poll() is not None:
+            return
+        try:
+            self.proc.send_signal(signal.SIGINT)
+        except OSError:
+            # It died in the meantime.
+            pass
+
+    def alive(self):
+        """
+        Whether the process runs, and is still heard: the reader thread
+        stops at the end of its stdout.
+        """
+        return self.proc.poll() is None and self.io_thread.is_alive()
 
     def get(self, block=True, timeout=None):
-        return self.queue.get(block, timeout)
+        (self.received_at, item) = self.queue.get(block, timeout)
+        return item
 
     def get_nowait(self):
-        return self.queue.get_nowait()
+        return self.get(False)
+
+    def write(self, data):
+        """
+        Writes the bytes [data] to the process, once [flush] is called: the
+        writes in between are sent all at once.
+        """
+        self._unflushed.append(data)
+
+    def send(self, data):
+        """
+        Writes the bytes [data] to the process right away, after whatever
+        [write] kept.
+        """
+        if self._unflushed:
+            self._unflushed.append(data)
+            self.flush()
+            return
+        self.proc.stdin.write(data)
+        self.proc.stdin.flush()
 
-    def write(self, string):
-        self.proc.stdin.write(string)
+    def flush(self):
+        if not self._unflushed:
+            return
+        (unflushed, self._unflushed) = (self._unflushed, [])
+        self.proc.stdin.write(b''.join(unflushed))
+        self.proc.stdin.flush()
 
@@ -0,0 +1,137 @@
+import json
+import math
+
+from collections import deque
+
+from sentence_index import sentence_digest
+
+#: What is measured for each call, in seconds:
+#: - send: writing the call to coqtop's pipe,
+#: - first_byte: from when coqtop started working on the call (the previous
+#:   one was answered) until the first message or answer about it was read,
+#: - coq: the same, until the answer was read: what coqtop (and the pipe)
+#:   took,
+#: - queue: how long the answer then waited for vim to look at it,
+#: - parse: building the result from the answer,
+#: - callback: what vim did with it (highlighting, goals, ...),
+#: - total: from the moment it was sent until all of the above was done.
+FIELDS = ('send', 'first_byte', 'coq', 'queue', 'parse', 'callback', 'total')
+
+class CallTrace (object):
+    """
+    Records how long every call to coqtop took, and where the time went (see
+    [FIELDS]).
+
+    Each call is written as a line of JSON to [path] if given, and the last
+    [history] calls of each kind are kept for [report]. Other costs (like
+    vim's redraws, or the number of calls into vim) can be recorded with
+    [span] and [count].
+    """
+
+    def __init__(self, path=None, history=1000):
+        self.path = path
+        self._file = None
+        self._history = history
+        #: Records of the last calls, by kind.
+        self.calls = {}
+        #: Durations of the other spans, by name.
+        self.spans = {}
+        #: Other measures, by (what is measured, name).
+        self.counts = {}
+
+    def record(self, future, started):
+        """
+        Records the [CoqFuture] [future], which coqtop started working on at
+        [started].
+        """
+        entry = {
+            'kind': future.kind,
+            'sent_at': future.sent_at,
+            'send': future.send_duration,
+            'first_byte': future.first_heard_at - started,
+            'coq': future.answered_at - started,
+            'queue': future.dispatched_at - future.answered_at,
+            'parse': future.parsed_at - future.dispatched_at,
+            'callback': future.completed_at - future.parsed_at,
+            'total': future.completed_at - future.sent_at,
+            'interrupted': future.interrupted_at is not None,
+        }
+        if future.sentence is not None:
+            entry['sentence'] = sentence_digest(future.sentence)
+        self._keep(self.calls, future.kind, (entry, future.sentence))
+        self._write(entry)
+
+    def span(self, name, seconds):
+        self._keep(self.spans, name, seconds)
+        self._write({'kind': name, 'total': seconds})
+
+    def count(self, what, name, value):
+        """ Records a [value] of [what] (e.g. calls into vim) for [name]. """
+        self._keep(self.counts, (what, name), value)
+        self._write({'kind': what, 'name': name, 'count': value})
+
+    def report(self):
+        """ The percentiles of every measure, and the slowest sentences. """
+        lines = ["%-10s %-10s %6s %9s %9s %9s %9s"
+                 % ('call', 'measure', 'count', 'p50', 'p90', 'p99', 'max')]
+        for kind in sorted(self.calls):
+            entries = [entry for (entry, _) in self.calls[kind]]
+            for field in FIELDS:
+                lines.append(_stats_line(kind, field,
+                                         [e[field] for e in entries]))
+        for name in sorted(self.spans):
+            lines.append(_stats_line(name, 'total', self.spans[name]))
+        if self.counts:
+            lines.append("")
+            lines.append("%-14s %-20s %6s %6s %6s %6s %6s"
+                         % ('measure', 'of', 'count', 'p50', 'p90', 'p99',
+                            'max'))
+        for (what, name) in sorted(self.counts):
+            values = sorted(self.counts[(what, name)])
+            lines.append("%-14s %-20s %6d %6d %6d %6d %6d" % (
+                what, name, len(values), percentile(values, 50),
+                percentile(values, 90), percentile(values, 99), values[-1]))
+        slowest = sorted(self.calls.get('interp', []),
+                         key=lambda call: -call[0]['coq'])[:5]
+        if slowest:
+            lines.append("")
+            lines.append("Slowest sentences:")
+        for (entry, sentence) in slowest:
+            text = ' '.join(sentence.split())
+            lines.append("%9.1fms  %s  %s" % (entry['coq'] * 1000,
+                                             entry['sentence'][:10], text[:60]))
+        return lines
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _keep(self, table, key, value):
+        if key not in table:
+            table[key] = deque([], self._history)
+        table[key].append(value)
+
+    def _write(self, entry):
+        if not self.path:
+            return
+        try:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+        except (IOError, OSError):
+            # Tracing is not worth failing over.
+            self.path = None
+
+def percentile(values, p):
+    """ The [p]th percentile of the sorted list [values] (nearest rank). """
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[min(len(values) - 1, max(0, rank))]
+
+def _stats_line(kind, field, values):
+    values = sorted(values)
+    return "%-10s %-10s %6d %7.1fms %7.1fms %7.1fms %7.1fms" % (
+        kind, field, len(values),
+        percentile(values, 50) * 1000, percentile(values, 90) * 1000,
+        percentile(values, 99) * 1000, values[-1] * 1000)
@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+
+from collections import OrderedDict
+
+from coqtop import Goal
+from json_file import read_json, write_json
+
+class Checkpoint (object):
+    """ What is known about the state reached after a sentence. """
+    def __init__(self, messages, goals_known=False, goals=None):
+        #: The messages Coq sent when accepting the sentence.
+        self.messages = messages
+        self.goals_known = goals_known
+        #: A list of [Goal], or None outside of a proof.
+        self.goals = goals
+
+class CheckpointCache (object):
+    """
+    Remembers, across sessions, which sentences Coq accepted and what it
+    answered.
+
+    A checkpoint is indexed by the digest of the whole prefix of the buffer
+    leading to it (see [StateIndex.prefixes]); and the cache of every coqtop
+    command line is a separate file of [directory]. So a hit means that the
+    exact same sentences were accepted by the exact same coqtop before, and
+    that they can be sent again in a row, without looking at the answers nor
+    asking for the goals in between.
+
+    Only the [size] most recently used checkpoints are kept.
+    """
+
+    def __init__(self, directory, coqtop_path, args, size=10000):
+        command_line = json.dumps([coqtop_path] + list(args))
+        name = hashlib.sha1(command_line.encode('utf-8')).hexdigest()
+        self.path = os.path.join(directory, name + '.json')
+        self.size = size
+        self._entries = None
+        self._dirty = False
+
+    def get(self, prefix):
+        """ Returns the [Checkpoint] of [prefix], or None. """
+        entries = self._load()
+        checkpoint = entries.get(prefix)
+        if checkpoint is not None:
+            del entries[prefix]
+            entries[prefix] = checkpoint
+        return checkpoint
+
+    def accepted(self, prefix, messages):
+        """ Records that Coq accepted the last sentence of [prefix]. """
+        checkpoint = self.get(prefix)
+        if checkpoint is None:
+            self._load()[prefix] = Checkpoint(messages)
+            self._shrink()
+        else:
+            checkpoint.messages = messages
+        self._dirty = True
+
+    def set_goals(self, prefix, goals):
+        """ Records the goals of the state reached after [prefix]. """
+        checkpoint = self.get(prefix)
+        if checkpoint is not None:
+            checkpoint.goals_known = True
+            checkpoint.goals = goals
+            self._dirty = True
+
+    def discard(self, prefix):
+        if self._load().pop(prefix, None) is not None:
+            self._dirty = True
+
+    def save(self):
+        """ Writes the cache back to disk, if it changed. """
+        if not self._dirty:
+            return
+        entries = [[prefix, c.messages, c.goals_known,
+                    None if c.goals is None else [list(g) for g in c.goals]]
+                   for (prefix, c) in self._entries.items()]
+        if write_json(self.path, entries):
+            self._dirty = False
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+        self._entries = OrderedDict()
+        entries = read_json(self.path, [])
+        for (prefix, messages, goals_known, goals) in entries:
+            if goals is not None:
+                goals = [Goal(*g) for g in goals]
+            self._entries[prefix] = Checkpoint(
+                [tuple(m) for m in messages], goals_known, goals)
+        return self._entries
+
+    def _shrink(self):
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
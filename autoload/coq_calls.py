@@ -0,0 +1,32 @@
+"""
+Encodes the calls sent to coqtop, straight to the bytes written on its pipe.
+
+The templates are bytes already, so a call only costs the encoding of its
+argument (once, to UTF-8) and a few byte replacements to escape it: no XML
+tree nor intermediate string is built.
+
+Every call carries the id [CoqTop] knows it by, see [CoqTop.pending].
+"""
+
+_INTERP     = b'<call id="%d" val="interp">%s</call>\n'
+_RAW_INTERP = b'<call id="%d" raw="true" val="interp">%s</call>\n'
+_REWIND     = b'<call id="%d" val="rewind" steps="%d"></call>\n'
+_GOAL       = b'<call id="%d" val="goal"></call>\n'
+
+#: Not answered, so it doesn't need an id of its own.
+QUIT = b'<call id="0" val="quit"></call>\n'
+
+def interp(call_id, sentence, raw=False):
+    """ The interp call of [sentence], a unicode string. """
+    return (_RAW_INTERP if raw else _INTERP) % (call_id, escape(sentence))
+
+def rewind(call_id, steps):
+    return _REWIND % (call_id, int(steps))
+
+def goal(call_id):
+    return _GOAL % call_id
+
+def escape(text):
+    """ [text] in UTF-8, with the characters XML gives a meaning escaped. """
+    return (text.encode('utf-8').replace(b'&', b'&amp;')
+            .replace(b'<', b'&lt;').replace(b'>', b'&gt;'))
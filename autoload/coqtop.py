@@ -1,24 +1,70 @@
 
-import signal
+import os
+import time
+import itertools
 import xml.etree.ElementTree as ET
-from xml.sax.saxutils import escape
 
 try:
     import Queue
 except ImportError:
     import queue as Queue
 
+import coq_calls
 import xml_stream_parser
 from async_pipe import AsyncPipe
+from timeout_policy import TimeoutPolicy
 
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import partial
 
 # Goal should have utf-8 encoded values
 Goal = namedtuple("Goal", ['identifier', 'hypothesis', 'conclusion'])
 
-# Maximum time to wait between coq responses
-TIMEOUT = 3.0
-# Under 0.5s is unreliable
+class CoqFuture (object):
+    """ The result of a call to coqtop, which might not be answered yet. """
+    def __init__(self, call_id, kind, parse, callback=None):
+        #: See [CoqTop.pending].
+        self.id = call_id
+        #: 'interp', 'goal' or 'rewind'
+        self.kind = kind
+        self.sent_at = time.time()
+        #: When coqtop was interrupted because it took too long, if it was.
+        self.interrupted_at = None
+        #: The sentence of an interp call.
+        self.sentence = None
+        #: Timings, see [CallTrace].
+        self.send_duration = 0.0
+        self.first_heard_at = None
+        self.answered_at = None
+        self.dispatched_at = None
+        self.parsed_at = None
+        self.completed_at = None
+        self._parse = parse
+        self._callback = callback
+        #: The messages coqtop sent while working on the call.
+        self.messages = []
+        #: Same as the return value of the blocking version of the call.
+        self.result = None
+        self.done = False
+        #: Whether coqtop was given up on: it didn't answer in time.
+        self.abandoned = False
+
+    def _complete(self, response):
+        self.result = self._parse(self.messages, response)
+        self.parsed_at = time.time()
+        self.done = True
+        if self._callback is not None:
+            self._callback(self)
+        self.completed_at = time.time()
+
+    def _abandon(self):
+        """ Completes the call without an answer, see [CoqTop.wait]. """
+        self.abandoned = True
+        self.result = (self.messages, None)
+        self.done = True
+        if self._callback is not None:
+            self._callback(self)
 
 class CoqTop (object):
     def __init__(self,
@@ -26,81 +72,319 @@ class CoqTop (object):
                  args,
                  logfile,
                  debug=False,
-                 xml_parser=None):
+                 xml_parser=None,
+                 timeouts=None,
+                 tracer=None):
 
         xml_parser = (xml_parser or
                       xml_stream_parser.enqueue_xml_stream)
-        # Other options are enqueue_xml, enqueue_xml_one_by_one
-
-        def ignore_sigint():
-            signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # Other options are enqueue_xml, enqueue_xml_one_by_one (python 2
+        # only, see ../bench/bench_xml.py)
 
+        # coqtop gets its own process group, so that hitting ^C in vim
+        # doesn't kill it. We still interrupt it explicitly with SIGINT, see
+        # [interrupt].
         self.coqtop = AsyncPipe(
             dict(
                 args=[coqtop_path, "-ideslave", "-debug"] + list(args),  #TODO debug flag
                 stderr=logfile,
-                preexec_fn=ignore_sigint),
+                preexec_fn=os.setpgrp),
             parser=xml_parser)
-        # TODO Windows support by passing in
-        # xml_stream_parser.enqueue_xml_one_by_one
+        # TODO Windows support: enqueue_xml_stream needs fcntl and select,
+        # and there is no os.setpgrp there.
         self.logfile = logfile
+        #: The calls sent to coqtop which haven't been answered yet, oldest
+        #: first, by id. coqtop answers them in order, so an answer goes to
+        #: the oldest one (unless it says which call it answers).
+        self.pending = OrderedDict()
+        self._ids = itertools.count(1)
+        #: How many states coqtop reached through interp calls it was given
+        #: up on, but accepted in the end: they have to be rewound, see
+        #: [drain].
+        self.strays = 0
+        #: See [TimeoutPolicy]
+        self.timeouts = timeouts or TimeoutPolicy()
+        #: See [CallTrace], if the calls are traced.
+        self.tracer = tracer
+        #: When coqtop last sent something, and last answered a call.
+        self._last_heard = time.time()
+        self._last_answer = self._last_heard
+        #: When the reader thread got the last answer, see [CallTrace].
+        self._last_received = self._last_heard
+        #: The calls written since the last [flush], and the depth of nested
+        #: [batch] blocks.
+        self._unflushed = []
+        self._batch_depth = 0
 
     def close(self):
-        try:
-            # TODO this crashes with error about closing coqtop.stdout while
-            # it's being used in another thread
-            self.coqtop.close()
-        except OSError:
-            pass
+        """
+        Asks coqtop to quit, and makes sure it did (see [AsyncPipe.close]).
+        """
+        if self.pending:
+            # It wouldn't read the quit call before being done otherwise.
+            self.interrupt()
+        self.coqtop.close(quit=coq_calls.QUIT)
 
     # Low level communication
 
     def send_cmd(self, xml_tree, encoding='utf-8'):
-        serialized = ET.tostring(xml_tree, encoding)
-        # log("TO coq: %s" % serialized)
-        self.coqtop.write(serialized)
+        self.send_bytes(ET.tostring(xml_tree, encoding))
 
     def send_text(self, string):
-        # log("TO coq: %s" % string)
-        self.coqtop.write("%s\n" % string)
+        self.send_bytes(("%s\n" % string).encode('utf-8'))
 
-    def get_answer(self):
-        messages = []
+    def send_bytes(self, data):
+        """ Writes [data] to coqtop, at the end of the current [batch]. """
+        if self._batch_depth == 0:
+            self.coqtop.send(data)
+        else:
+            self.coqtop.write(data)
+
+    @contextmanager
+    def batch(self):
+        """
+        Sends the calls made in the block all at once, at the end of it (or
+        before waiting for an answer).
+        """
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.flush()
+
+    def flush(self):
+        """ Actually sends what was written to coqtop. """
+        self.coqtop.flush()
+        if not self._unflushed:
+            return
+        now = time.time()
+        for future in self._unflushed:
+            future.send_duration = now - future.sent_at
+        del self._unflushed[:]
+
+    def poll(self):
+        """ Processes every answer coqtop sent so far, without blocking.
+
+        The callbacks of the calls which got answered are run from here.
+        A call coqtop is given up on (see [wait]) completes with a None
+        response. Returns False if coqtop died.
+        """
+        self.flush()
         while True:
             try:
-                response = self.coqtop.get(True, TIMEOUT)
-                if response.tag == "message":
-                    message = CoqTop._parse_message(response)
-                    if message is not None:
-                        messages.append(message)
-                    else:
-                        self.logfile.write("Dropping unparsed message: {}\n"
-                                      .format(ET.tostring(response)))
-                elif response.tag == "value":
-                    return (messages, response)
-                else:
-                    self.logfile.write("Unknown xml response: {}\n".format(
-                        ET.tostring(response)))
+                response = self.coqtop.get_nowait()
+            except Queue.Empty:
+                break
+            self._dispatch(response)
+        if not self.pending:
+            return True
+        if not self.alive():
+            return False
+        if self._overdue():
+            self._current()._abandon()
+        return True
+
+    def wait(self, future):
+        """ Blocks until [future] is answered and returns its result.
+
+        Returns (messages, None) if coqtop dies before that, or if it exceeds
+        the budget its [TimeoutPolicy] gives (if any) and then doesn't even
+        answer to being interrupted: the call is given up on. It still is pending
+        then: its answer, if it ever arrives, is drained rather than given to
+        the next call (see [drain]).
+        """
+        self.flush()
+        while not future.done:
+            try:
+                response = self.coqtop.get(True, self.timeouts.poll_interval)
+            except Queue.Empty:
+                if not self.alive():
+                    return (future.messages, None)
+                if self._overdue():
+                    # Maybe a call sent before [future].
+                    self._current()._abandon()
+                continue
+            self._dispatch(response)
+        return future.result
+
+    def drain(self, timeout=None):
+        """
+        Waits for the answers to the calls coqtop was given up on, at most
+        [timeout] seconds (its grace period by default): coqtop works on them
+        before any other call. The interp calls it accepted anyway are
+        counted in [strays].
+        Returns False if some are still unanswered.
+        """
+        if timeout is None:
+            timeout = self.timeouts.grace
+        deadline = time.time() + timeout
+        self.flush()
+        while self.orphans():
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.alive():
+                return False
+            try:
+                response = self.coqtop.get(
+                    True, min(remaining, self.timeouts.poll_interval))
             except Queue.Empty:
-                return (messages, None)
+                continue
+            self._dispatch(response)
+        return True
+
+    def abandon(self, future):
+        """
+        Gives up on [future], which completes right away without an answer:
+        its answer is drained when it arrives, see [drain].
+        """
+        if not future.done:
+            future._abandon()
+
+    def orphans(self):
+        """ Whether some calls coqtop was given up on are unanswered. """
+        return any(future.abandoned for future in self.pending.values())
+
+    def _current(self):
+        """ The oldest call which isn't given up on, if any. """
+        for future in self.pending.values():
+            if not future.abandoned:
+                return future
+        return None
+
+    def _overdue(self):
+        """
+        Interrupts coqtop if it has been silent for longer than the budget of
+        the call it is working on, if it has one (see [TimeoutPolicy]).
+        Returns True if it then stayed silent during the whole grace period.
+        """
+        current = self._current()
+        if current is None:
+            return False
+        now = time.time()
+        if current.interrupted_at is not None:
+            return now - current.interrupted_at > self.timeouts.grace
+        budget = self.timeouts.budget(current.kind)
+        if budget is None:
+            return False
+        silence = now - max(self._last_heard, current.sent_at)
+        if silence > budget:
+            self.logfile.write("coqtop silent for {:.1f}s on a {} call, "
+                               "interrupting it\n".format(silence, current.kind))
+            current.interrupted_at = now
+            self.coqtop.interrupt()
+        return False
+
+    def interrupt(self):
+        """ Asks coqtop to abort the call it is currently working on.
+
+        That call then fails with an "interrupted" error.
+        """
+        if self.pending:
+            self.coqtop.interrupt()
+
+    def alive(self):
+        return self.coqtop.alive()
+
+    def _submit(self, kind, encode, parse, callback, sentence=None):
+        """
+        Sends the call [encode(call_id)], see [coq_calls].
+        """
+        call_id = next(self._ids)
+        future = CoqFuture(call_id, kind, parse, callback)
+        future.sentence = sentence
+        self.pending[call_id] = future
+        if self._batch_depth == 0:
+            self.coqtop.send(encode(call_id))
+            future.send_duration = time.time() - future.sent_at
+        else:
+            # Sent by [flush], see [batch].
+            self._unflushed.append(future)
+            self.coqtop.write(encode(call_id))
+        return future
+
+    def _answered(self, response):
+        """ The pending call [response] answers, if any. """
+        if not self.pending:
+            return None
+        call_id = response.get('id')
+        if call_id is not None and call_id.isdigit() and \
+                int(call_id) in self.pending:
+            return self.pending.pop(int(call_id))
+        return self.pending.popitem(last=False)[1]
+
+    def _drained(self, future, response):
+        """ The late answer to [future], which coqtop was given up on. """
+        (_, result) = future._parse(future.messages, response)
+        accepted = future.kind == 'interp' and result is not None and \
+            result[0]
+        if accepted:
+            self.strays += 1
+        self.logfile.write("Drained the late answer to call {} ({}{})\n"
+                           .format(future.id, future.kind,
+                                   ", accepted" if accepted else ""))
+
+    def _dispatch(self, response):
+        self._last_heard = time.time()
+        oldest = next(iter(self.pending.values()), None)
+        if oldest is not None and oldest.first_heard_at is None:
+            oldest.first_heard_at = self.coqtop.received_at
+        if response.tag == "message":
+            message = CoqTop._parse_message(response)
+            if message is None:
+                self.logfile.write("Dropping unparsed message: {}\n"
+                              .format(ET.tostring(response)))
+            elif oldest is not None:
+                oldest.messages.append(message)
+            else:
+                self.logfile.write("Dropping unexpected message: {}\n"
+                              .format(message))
+        elif response.tag == "value":
+            future = self._answered(response)
+            if future is not None and future.abandoned:
+                self._last_answer = self._last_heard
+                self._last_received = self.coqtop.received_at
+                self._drained(future, response)
+            elif future is not None:
+                # Calls are processed one after the other: this one started
+                # when the previous one was answered.
+                started = max(future.sent_at, self._last_answer)
+                self._last_answer = self._last_heard
+                if future.interrupted_at is None:
+                    self.timeouts.record(future.kind,
+                                         self._last_answer - started)
+                future.answered_at = self.coqtop.received_at
+                future.dispatched_at = self._last_heard
+                # Same as [started], but as seen from the reader thread.
+                coq_started = max(future.sent_at, self._last_received)
+                self._last_received = future.answered_at
+                future._complete(response)
+                if self.tracer is not None:
+                    self.tracer.record(future, coq_started)
+            else:
+                self.logfile.write("Dropping unexpected answer: {}\n".format(
+                    ET.tostring(response)))
+        else:
+            self.logfile.write("Unknown xml response: {}\n".format(
+                ET.tostring(response)))
 
     # Smart commands
     # All return (messages, response)
     # if the request timed out, response is None
     # Otherwise it depends
+    #
+    # The send_* variants don't wait for the answer: they return a
+    # [CoqFuture], whose result will be the same (messages, response) pair.
+    # [callback] is called with the future once it is answered, either from
+    # [poll] or [wait].
 
     def rewind(self, steps):
-        x = int(steps) # Check that steps is integral
-        self.send_text('<call id="1" val="rewind" steps="{}"></call>'
-                       .format(x))
-        (messages, response) = self.get_answer()
-        if response.get('val') == 'good':
-            int_container = response.find('int')
-            if int_container is not None:
-                # TODO error handling
-                return (messages, int(int_container.text))
-        return (messages, None)
+        return self.wait(self.send_rewind(steps))
 
+    def send_rewind(self, steps, callback=None):
+        steps = int(steps) # Check that steps is integral
+        return self._submit('rewind', partial(coq_calls.rewind, steps=steps),
+                            CoqTop._parse_rewind, callback)
 
     def interp(self, message, raw=False):
         """ Returns (messages, (ok, extra_data))
@@ -110,48 +394,72 @@ class CoqTop (object):
         messages will have the reason for failing included in it,
         at level 'error'.
         """
-        if not raw:
-            self.send_text('<call id="1" val="interp">{}</call>'
-                             .format(escape(message)))
-        else:
-            self.send_text('<call id="1" raw="true" val="interp">{}</call>'
-                             .format(escape(message)))
-        (messages, response) = self.get_answer()
+        return self.wait(self.send_interp(message, raw))
+
+    def send_interp(self, message, raw=False, callback=None):
+        """ Sends an interp call without waiting for its answer.
+
+        Several calls can be sent in a row, coqtop answers them in order.
+        """
+        return self._submit('interp', partial(coq_calls.interp,
+                                              sentence=message, raw=raw),
+                            CoqTop._parse_interp, callback, sentence=message)
+
+    def goals(self):
+        return self.wait(self.send_goals())
+
+    def send_goals(self, callback=None):
+        return self._submit('goal', coq_calls.goal,
+                            CoqTop._parse_goal_answer, callback)
+
+    # XML parsers
+    # The _parse_*(messages, response) functions build the results of the
+    # calls from their answer.
+
+    @staticmethod
+    def _parse_rewind(messages, response):
+        if response.get('val') == 'good':
+            int_container = response.find('int')
+            if int_container is not None:
+                # TODO error handling
+                return (messages, int(int_container.text))
+        return (messages, None)
+
+    @staticmethod
+    def _parse_interp(messages, response):
         # I'm tired of being nagged
         messages = [(level, text) for (level, text) in messages
                     if text !=
                     "Query commands should not be inserted in scripts"]
 
-        if response is None:
-            return (messages, None)
         if response.get('val') == 'good':
             return (messages, (True, None))
         elif response.get('val') == 'fail':
             fail_msg = ('error', response.text)
             messages.append(fail_msg)
-            return (messages,
-                    (False,
-                     (int(response.get('loc_s')),
-                      int(response.get('loc_e')))))
+            # An interrupted call fails without a location.
+            loc_s = response.get('loc_s')
+            loc_e = response.get('loc_e')
+            if loc_s is None or loc_e is None:
+                return (messages, (False, None))
+            return (messages, (False, (int(loc_s), int(loc_e))))
         elif response.get('val') == 'unsafe':
             # This means we used Admited or friends.
             # Just make sure the editor highlights it ok.
             return (messages, (True, 'Unsafe'))
         else:
             print("(ANOMALY) unknown answer: %s" % ET.tostring(response))
+            return (messages, None)
 
-    def goals(self):
-        self.send_text('<call id="1" val="goal"></call>')
-        (messages, response) = self.get_answer()
+    @staticmethod
+    def _parse_goal_answer(messages, response):
         (ok, goals) = CoqTop._parse_goals(response)
         if ok:
             return (messages, goals)
         else:
             # TODO handle better
-            return (messages, goals)
-
+            return (messages, None)
 
-    # XML parsers
     @staticmethod
     def _parse_goals(resp):
         # <goals><list>
@@ -1,26 +1,45 @@
-import vim
-
+import os
 import re
+import time
 
-from collections import deque
+from functools import partial, wraps
 
+from call_trace import CallTrace
+from checkpoint_cache import CheckpointCache
 from coqtop import CoqTop
+from highlight import make_highlighter
+from panels import Panels
+from sentence_index import normalize, sentence_digest, prefix_digest
+from session import Session, SessionPool
+from timeout_policy import TimeoutPolicy, BLOCKING_BUDGETS
+from vim_context import Contexts
+from vo_build import BuildCache, VoBuilder
 
 import vimbufsync
 vimbufsync.check_version("0.1.0", who="coquille")
 
-#: Pipe used to discuss with coqtop
-coqtop = None
+#: The [Session] of every buffer Coquille was launched in. Each of them has
+#: its own coqtop, at most [g:coquille_max_sessions] of them are running.
+sessions = SessionPool()
+
+#: At most [GOAL_CACHE_SIZE] goals are kept by session, see [_goals].
+GOAL_CACHE_SIZE = 256
+
+#: Timings of the calls to coqtop (and of the redraws), see [print_stats].
+tracer = CallTrace()
 
-#: See vimbufsync ( https://github.com/def-lkb/vimbufsync )
-saved_sync = None
+#: What [_build_deps] compiled, when [g:coquille_cache_dir] isn't set.
+builds = BuildCache()
 
-#: Keeps track of what have been checked by Coq, and what is waiting to be
-#: checked.
-encountered_dots = []
-send_queue = deque([])
+#: What the current command exchanges with vim, see [_command].
+contexts = Contexts(tracer)
 
-error_at = None
+#: The Goals and Infos panels, shared by every session.
+panels = Panels(contexts)
+
+#: What the Goals panel currently shows:
+#: (buffer number, [Session.state_id], goals)
+shown_goals = (None, None, None)
 
 # TODO remove this
 logfile = open('/tmp/coqutille_log.txt', 'w')
@@ -29,147 +48,420 @@ def log(msg):
     logfile.write(str(msg) + "\n")
     logfile.flush()
 
+def _command(f):
+    """
+    [f] is called by vim: it gets a [Context] of its own, and its effects on
+    vim (including the writes to the panels, see [Panels.batch]) are applied
+    at once when it is done.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with contexts.command(f.__name__):
+            with panels.batch():
+                return f(*args, **kwargs)
+    return wrapper
+
 ###################
 # synchronization #
 ###################
 
-def sync():
-    global saved_sync
+@_command
+def sync(refresh_after=True):
+    """
+    Rewinds whatever was modified in the buffer since the last call.
+    Only the sentences whose text actually changed (not just their comments
+    or blanks) are rewound, see [_resync_from].
+    The panels and colors are refreshed afterward, unless [refresh_after] is
+    False: the caller then takes care of it.
+    """
+    session = _current()
+    if session is None:
+        return
     curr_sync = vimbufsync.sync()
+    saved_sync = session.saved_sync
     if not saved_sync or curr_sync.buf() != saved_sync.buf():
-        _reset()
+        _finish_async(session)
+        if session.highlighter is not None:
+            session.highlighter.edited((0, 0))
+        _reset(session)
     else:
         (line, col) = saved_sync.pos()
-        rewind_to(line - 1, col) # vim indexes from lines 1, coquille from 0
-    saved_sync = curr_sync
+        if session.highlighter is not None:
+            session.highlighter.edited((line - 1, col))
+        if session.send_queue and \
+                (line - 1, col) <= session.send_queue[-1]['stop']:
+            # The commands still waiting for coqtop might have been modified.
+            _finish_async(session)
+        session.sentences.invalidate(line - 1)
+        session.offsets.invalidate(line - 1)
+        if session.prefetch_error and \
+                (line - 1, col) <= session.prefetch_error:
+            session.prefetch_error = None
+        # vim indexes from lines 1, coquille from 0
+        _resync_from(session, line - 1, col, refresh_after)
+    session.saved_sync = curr_sync
+    session.synced_tick = _changedtick(session)
+
+def _changedtick(session):
+    return int(contexts.current().eval("getbufvar(%d, 'changedtick')"
+                                       % session.bufnr))
+
+def _edited_before(session, pos):
+    """
+    Whether the buffer was modified before [pos] since the last [sync].
+    Only insert mode triggers one: the positions computed since are stale
+    after a normal mode edit, until the next command.
+    """
+    if _changedtick(session) == session.synced_tick:
+        return False
+    if session.saved_sync is None:
+        return True
+    (line, col) = session.saved_sync.pos()
+    return (line - 1, col) <= pos
 
-def _reset():
-    global saved_sync, encountered_dots, error_at, send_queue
-    encountered_dots = []
-    send_queue = deque([])
-    saved_sync = None
-    error_at   = None
-    reset_color()
+def _resync_from(session, line, col, refresh_after):
+    """
+    The buffer has been modified from [(line, col)] onward: compares the
+    sentences Coq accepted after that position with what the buffer now
+    contains, rewinds from the first one which changed, and moves the other
+    ones to their new position.
+    """
+    if session.coqtop is None:
+        return
+    encountered_dots = session.encountered_dots
+    # An edit right after a dot can make it part of a longer sentence.
+    first = max(0, encountered_dots.states_until((line, col)) - 1)
+    positions = _unchanged_ends(session, first)
+    target = first + len(positions)
+    rewound = target < len(encountered_dots)
+    if rewound:
+        _rewind(session, target, refresh_after=False)
+    kept = len(encountered_dots) - first
+    moved = kept > 0 and encountered_dots.relocate(first, positions[:kept])
+    if refresh_after and (rewound or moved):
+        refresh(session)
+
+def _unchanged_ends(session, first):
+    """
+    Rescans the sentences Coq accepted after its state number [first], and
+    returns their new end positions, up to the first one whose text changed.
+    """
+    encountered_dots = session.encountered_dots
+    context = contexts.current()
+    buff = context.lines(session.bufnr)
+    encoding = context.option('fileencoding') or "utf-8"
+    pos = encountered_dots[first - 1] if first > 0 else (0, 0)
+    positions = []
+    for state in range(first, len(encountered_dots)):
+        stop = session.sentences.next_chunk(buff, pos[0], pos[1])
+        if stop is None:
+            break
+        command = _between(session, pos, stop).decode(encoding)
+        if sentence_digest(command) != encountered_dots.digests[state]:
+            break
+        pos = (stop[0], stop[1] + 1)
+        positions.append(pos)
+    return positions
+
+def _reset(session):
+    session.reset()
+    reset_color(session)
 
 #####################
 # exported commands #
 #####################
 
+@_command
 def restart_coq(*args):
-    global coqtop
-    if coqtop: coqtop.close()
+    bufnr = int(contexts.current().option('bufnr'))
+    session = sessions.get(bufnr)
+    if session is None:
+        session = Session(bufnr, args)
+        sessions.add(session)
+    else:
+        # Whatever was checked by the previous coqtop has to be checked again.
+        session.stop()
+        session.args = args
+    reset_color(session)
+    _start(session)
+
+def _start(session):
+    """ Launches the coqtop of [session], making room for it if needed. """
+    context = contexts.current()
+    sessions.max_running = int(context.option('max_sessions'))
+    for stopped in sessions.make_room(session):
+        log("Stopped the coqtop of buffer %d" % stopped.bufnr)
+    coqtop_path = context.option('coqtop_path')
+    if context.option('build_deps') == 'true':
+        _build_deps(session, coqtop_path)
     try:
-        coqtop_path = vim.eval('g:coquille_coqtop_path')
-        coqtop = CoqTop(coqtop_path, args, logfile)
+        given = context.option('timeouts')
+        budgets = dict((kind, float(seconds))
+                       for (kind, seconds) in given.items())
+        if not _is_async():
+            for (kind, seconds) in BLOCKING_BUDGETS.items():
+                budgets.setdefault(kind, seconds)
+        timeouts = TimeoutPolicy(budgets)
+        trace_file = context.option('trace_file')
+        tracer.path = os.path.expanduser(trace_file) if trace_file else None
+        session.coqtop = CoqTop(coqtop_path, session.args, logfile,
+                                timeouts=timeouts, tracer=tracer)
+        cache_dir = context.option('cache_dir')
+        session.checkpoints = (CheckpointCache(os.path.expanduser(cache_dir),
+                                               coqtop_path, session.args)
+                               if cache_dir else None)
     except OSError:
         print("Error: couldn't launch hoqtop")
 
-def kill_coqtop():
-    if coqtop: coqtop.close()
+def _build_deps(session, coqtop_path):
+    """
+    Compiles the libraries the buffer of [session] requires whose .vo is
+    missing or out of date, with the coqc next to coqtop, see [VoBuilder].
+    """
+    context = contexts.current()
+    encoding = context.option('fileencoding') or "utf-8"
+    lines = [line.decode(encoding)
+             for line in context.lines(session.bufnr)]
+    cache_dir = context.option('cache_dir')
+    cache = (BuildCache(os.path.join(os.path.expanduser(cache_dir),
+                                     'builds.json'))
+             if cache_dir else builds)
+    coqc_path = os.path.join(os.path.dirname(coqtop_path), 'coqc')
+    this_file = context.eval("fnamemodify(bufname(%d), ':p')" % session.bufnr)
+    start = time.time()
+    try:
+        (built, failed) = VoBuilder(coqc_path, session.args, cache).build(
+            lines, exclude=this_file)
+    except OSError:
+        print("Error: couldn't launch %s" % coqc_path)
+        return
+    for (path, output) in failed:
+        print("ERROR: couldn't compile %s: %s" % (path,
+                                                  ' '.join(output.split())))
+    if built:
+        print("Compiled %d libraries in %.1fs" % (len(built),
+                                                   time.time() - start))
+
+def kill_coqtop(bufnr=None):
+    if bufnr is None:
+        bufnr = int(contexts.current().option('bufnr'))
+    sessions.remove(bufnr)
+
+def save_checkpoints():
+    for session in sessions:
+        if session.checkpoints is not None:
+            session.checkpoints.save()
 
 def goto_last_sent_dot():
-    (line, col) = (0,1) if encountered_dots == [] else encountered_dots[-1]
-    vim.current.window.cursor = (line + 1, col)
+    session = _current()
+    if session is not None:
+        _goto_last_sent_dot(session)
+
+def _goto_last_sent_dot(session):
+    if not _is_current(session):
+        return
+    checked = session.committed()
+    (line, col) = (0,1) if not checked else session.encountered_dots[checked - 1]
+    contexts.current().set_cursor(line + 1, col)
+
+@_command
+def coq_rewind(steps=1, refresh_after=True):
+    session = _current()
+    if session is None:
+        print("Error: Coqtop isn't running. Are you sure you called :CoqLaunch?")
+        return
 
-def coq_rewind(steps=1):
-    global encountered_dots
+    _finish_async(session)
 
-    if steps < 1 or encountered_dots == []:
+    checked = session.committed()
+    if steps < 1 or not checked:
         return
 
-    if coqtop is None:
-        print("Error: Coqtop isn't running. Are you sure you called :CoqLaunch?")
+    if not _rewind(session, max(0, checked - steps), refresh_after):
         return
 
-    (messages, additional_steps) = coqtop.rewind(steps)
+    # The other rewinds happen when the user calls "CoqToCursor" or just
+    # started editing in the "locked" zone. In both these cases we don't want
+    # to move the cursor.
+    if (steps == 1 and _auto_move()):
+        _goto_last_sent_dot(session)
+
+def _rewind(session, target, refresh_after):
+    """
+    Goes back to the state [target], or before it if it is inside of a closed
+    proof.
+    Returns False if coqtop died.
+    """
+    _finish_async(session)
+    if not _settle(session):
+        return False
+
+    # Rewinding into a closed proof rewinds it as a whole: ask for it directly.
+    encountered_dots = session.encountered_dots
+    nb_states = len(encountered_dots)
+    planned = nb_states - encountered_dots.keepable(min(target, nb_states))
+    if planned < 1:
+        return True
+
+    (messages, additional_steps) = session.coqtop.rewind(planned)
 
     if additional_steps is None:
-        vim.command("call coquille#KillSession()")
+        _kill_session(session)
         print('ERROR: the Coq process died')
-        return
-
-    nb_removed = steps + additional_steps
-    encountered_dots = encountered_dots[:len(encountered_dots) - nb_removed]
+        return False
 
-    refresh()
-    show_info("")
+    _forget_states(session, planned + additional_steps)
 
-    # steps != 1 means that either the user called "CoqToCursor" or just started
-    # editing in the "locked" zone. In both these cases we don't want to move
-    # the cursor.
-    if (steps == 1 and vim.eval('g:coquille_auto_move') == 'true'):
-        goto_last_sent_dot()
+    if refresh_after:
+        refresh(session)
+    show_info(session, "")
+    return True
 
+@_command
 def coq_to_cursor():
-    if coqtop is None:
+    session = _current()
+    if session is None:
         print("Error: Coqtop isn't running. Are you sure you called :CoqLaunch?")
         return
 
-    sync()
+    sync(refresh_after=False)
 
-    (cline, ccol) = vim.current.window.cursor
-    (line, col)  = encountered_dots[-1] if encountered_dots else (0,0)
+    (cline, ccol) = [int(x) for x in contexts.current().option('cursor')]
+    nb_committed = _commit(session, (cline - 1, ccol))
+    (line, col)  = _checked_position(session)
 
-    if cline < line or (cline == line and ccol < col):
-        rewind_to(cline - 1, ccol)
+    if (cline - 1, ccol) < (line, col):
+        _finish_async(session)
+        _rewind_to(session, cline - 1, ccol, refresh_after=False)
+        refresh(session)
     else:
-        while True:
-            r = _get_message_range((line, col))
-            if r is not None and r['stop'] <= (cline - 1, ccol):
-                line = r['stop'][0]
-                col  = r['stop'][1] + 1
-                send_queue.append(r)
-            else:
-                break
-
-        send_until_fail()
-
+        # Otherwise the sentence after the cursor is already being checked.
+        if not _is_speculating(session):
+            (line, col) = _last_position(session)
+            while True:
+                r = _get_message_range(session, (line, col))
+                if r is not None and r['stop'] <= (cline - 1, ccol):
+                    line = r['stop'][0]
+                    col  = r['stop'][1] + 1
+                    session.send_queue.append(r)
+                else:
+                    break
+
+        if nb_committed:
+            _committed(session)
+        send_until_fail(session)
+
+@_command
 def coq_next():
-    if coqtop is None:
+    session = _current()
+    if session is None:
         print("Error: Coqtop isn't running. Are you sure you called :CoqLaunch?")
         return
 
-    sync()
+    sync(refresh_after=False)
+
+    if _commit(session):
+        _committed(session)
+        if _auto_move():
+            if any(not r.get('speculative') for r in session.send_queue):
+                # It is still being checked.
+                session.move_when_done = True
+            else:
+                _goto_last_sent_dot(session)
+        return
 
-    (line, col)  = encountered_dots[-1] if encountered_dots else (0,0)
-    message_range = _get_message_range((line, col))
+    (line, col)  = _last_position(session)
+    message_range = _get_message_range(session, (line, col))
 
-    if message_range is None: return
+    if message_range is None:
+        refresh(session)
+        return
 
-    send_queue.append(message_range)
+    session.send_queue.append(message_range)
 
-    send_until_fail()
+    send_until_fail(session)
 
-    if (vim.eval('g:coquille_auto_move') == 'true'):
-        goto_last_sent_dot()
+    if _auto_move():
+        if session.in_flight:
+            session.move_when_done = True
+        else:
+            _goto_last_sent_dot(session)
 
+@_command
 def coq_raw_query(*args):
     # log("Starting query with args %s" %(args))
-    if coqtop is None:
+    session = _current()
+    if session is None:
         log("Error: Coqtop isn't running. Are you sure you called :CoqLaunch?")
         return
 
     raw_query = ' '.join(args)
 
-    encoding = vim.eval("&encoding")
+    encoding = contexts.current().option('encoding')
 
     log("About to send cmd")
-    (messages, response) = coqtop.interp(raw_query.decode(encoding), raw=True)
-    handle_messages(messages)
+    session.info.start()
+    (messages, response) = session.coqtop.interp(raw_query.decode(encoding),
+                                                 raw=True)
+    handle_messages(session, messages)
     if response is None:
-        vim.command("call coquille#KillSession()")
+        _kill_session(session)
         print('ERROR: the Coq process died')
         return
     # Doesn't even matter what response is, if it's failure,
     # that's a message.
 
+def coq_interrupt():
+    session = sessions.get(_current_bufnr())
+    if session is not None and session.coqtop is not None:
+        session.coqtop.interrupt()
+
 def launch_coq(*args):
     restart_coq(*args)
 
+@_command
+def poll():
+    """
+    Processes the answers the coqtops sent so far.
+    Called regularly by a timer in asynchronous mode, see [send_until_fail].
+    """
+    for session in sessions:
+        coqtop = session.coqtop
+        if coqtop is None or not coqtop.pending:
+            continue
+        if not coqtop.poll():
+            _coqtop_died(session)
+        elif session.settling and not coqtop.orphans():
+            if _settle(session) and not session.in_flight:
+                _batch_done(session)
+
+@_command
+def buffer_entered():
+    """
+    Shows the state of the session of the current buffer: another one might
+    have been using the panels in the meantime.
+    """
+    session = sessions.get(_current_bufnr())
+    if session is not None:
+        panels.show_info(list(session.info.lines))
+        refresh(session)
+
+def print_stats():
+    """
+    Prints the percentiles of the time taken by the calls to coqtop, layer
+    by layer, see [CallTrace].
+    """
+    if not tracer.calls:
+        print("No call to coqtop yet")
+        return
+    for line in tracer.report():
+        print(line)
+
 def debug():
-    if encountered_dots:
+    session = _current()
+    if session is not None and session.encountered_dots:
         print("encountered dots = [")
-        for (line, col) in encountered_dots:
+        for (line, col) in session.encountered_dots:
             print("  (%d, %d) ; " % (line, col))
         print("]")
 
@@ -177,308 +469,686 @@ def debug():
 # IDE tools: Goal, Infos and colors #
 #####################################
 
-def refresh():
-    show_goal()
-    reset_color()
+def refresh(session):
+    show_goal(session)
+    reset_color(session)
 
-def show_goal():
-    buff = None
-    for b in vim.buffers:
-        if re.match(".*Goals$", b.name):
-            buff = b
-            break
-    del buff[:]
+def show_goal(session):
+    if not _is_current(session) or panels.goals is None:
+        return
+
+    (shown_in, shown_state, _) = shown_goals
+    if shown_in == panels.goals.number and shown_state == session.state_id:
+        return
+    if not panels.visible(panels.goals):
+        # Nobody would see them, the goals will be fetched when the panel is
+        # shown again.
+        return
 
-    (messages, goals) = coqtop.goals()
+    _display_goals(_goals(session), session.state_id)
+
+def _display_goals(goals, shown_state):
+    """ Shows [goals], the ones of the state [shown_state]. """
+    global shown_goals
+
+    (shown_in, _, shown) = shown_goals
+    if shown_in != panels.goals.number:
+        shown = None
+    (lines, changed) = _goal_lines(goals, shown)
+    panels.show_goals(lines, changed)
+    shown_goals = (panels.goals.number, shown_state, goals)
+
+def _goals(session):
+    """ Returns the current goals, only asking coqtop if they aren't known. """
+    state = session.committed()
+    if state not in session.goal_cache and state in session.prefetched_goals:
+        session.coqtop.wait(session.prefetched_goals[state])
+    if state not in session.goal_cache:
+        if session.speculative and \
+                not _rewind(session, state, refresh_after=False):
+            # coqtop is ahead of the state whose goals we want, and can't be
+            # brought back to it.
+            return None
+        (messages, goals) = session.coqtop.goals()
+        _cache_goals(session, state, goals)
+    return session.goal_cache[state]
+
+def _cache_goals(session, state, goals):
+    goal_cache = session.goal_cache
+    goal_cache[state] = goals
+    if len(goal_cache) > GOAL_CACHE_SIZE:
+        goal_cache.popitem(last=False)
+    encountered_dots = session.encountered_dots
+    if session.checkpoints is not None and 0 < state <= len(encountered_dots):
+        session.checkpoints.set_goals(encountered_dots.prefixes[state - 1],
+                                      goals)
+
+def _infer_goals(session, command):
+    """
+    Called when Coq accepts [command]: outside of a proof, the goals of the
+    new state are known to be empty as long as [command] can't start a proof,
+    so there is no need to ask coqtop for them.
+    """
+    state = len(session.encountered_dots)
+    if state in session.goal_cache and session.goal_cache[state] is None \
+            and not _may_start_proof(command):
+        _cache_goals(session, state + 1, None)
 
+def _goal_lines(goals, previous):
+    """
+    Returns the lines of the Goals panel showing [goals], and the ranges of
+    lines (first, last) of the hypotheses which weren't in the [previous]
+    goals.
+    """
     if goals is None:
-        return
+        return ([''], [])
 
     plural_opt = '' if len(goals) == 1 else 's'
-    buff.append(['%d subgoal%s' % (len(goals), plural_opt), ''])
+    lines = ['%d subgoal%s' % (len(goals), plural_opt), '']
+    changed = []
+    # Everything is new when entering a proof, no need to highlight it all.
+    known = set(previous[0].hypothesis) if previous else None
 
     for idx, goal in enumerate(goals):
         if idx == 0:
             # we print the environment only for the current subgoal
             for hyp in goal.hypothesis:
-                buff.append(hyp.split('\n'))
-        buff.append('')
-        buff.append('======================== ( %d / %d )' % (idx+1 , len(goals)))
-        buff.append(goal.conclusion.split("\n"))
-        buff.append('')
-
-def show_info(info_msg):
-    buff = None
-    for b in vim.buffers:
-        if re.match(".*Infos$", b.name):
-            buff = b
-            break
+                first = len(lines)
+                lines.extend(hyp.split('\n'))
+                if known is not None and hyp not in known:
+                    changed.append((first, len(lines) - 1))
+        lines.append('')
+        lines.append('======================== ( %d / %d )' % (idx+1 , len(goals)))
+        lines.extend(goal.conclusion.split("\n"))
+        lines.append('')
+    return (lines, changed)
+
+def show_info(session, info_msg):
+    session.info.resize(int(contexts.current().option('info_size')))
+    session.info.set(info_msg)
+    if _is_current(session):
+        panels.show_info(list(session.info.lines))
+
+def handle_messages(session, messages):
+    """
+    Adds [messages] to the Infos panel as they arrive, or replaces what it
+    shows with them if they are the first ones of a command (see
+    [MessageLog]). Only the levels of [g:coquille_message_levels] are shown.
+    """
+    info = session.info
+    context = contexts.current()
+    size = int(context.option('info_size'))
+    info.resize(size)
+    levels = context.option('message_levels')
+    (lines, replaced) = info.add(messages, levels)
+    if not lines or not _is_current(session):
+        return
+    if replaced:
+        panels.show_info(list(info.lines))
+    else:
+        panels.append_info(lines, size)
 
-    del buff[:]
-    if info_msg is not None:
-        lst = info_msg.split('\n')
-        buff.append(lst)
-
-def handle_messages(messages):
-    new_info_msg = ""
-    for message in messages:
-        level, info = message
-        if info:
-            new_info_msg += info
-            new_info_msg += "\n\n"
-
-    # TODO if we want persistant messages do this
-    # otherwise unconditionally show the new message
-    if len(new_info_msg) > 0:
-        show_info(new_info_msg)
-
-def reset_color():
-    global error_at
-    # Clear current coloring (dirty)
-    if int(vim.eval('b:checked')) != -1:
-        vim.command('call matchdelete(b:checked)')
-        vim.command('let b:checked = -1')
-    if int(vim.eval('b:sent')) != -1:
-        vim.command('call matchdelete(b:sent)')
-        vim.command('let b:sent = -1')
-    if int(vim.eval('b:errors')) != -1:
-        vim.command('call matchdelete(b:errors)')
-        vim.command('let b:errors = -1')
-    # Recolor
-    if encountered_dots:
-        (line, col) = encountered_dots[-1]
-        start = { 'line': 0 , 'col': 0 }
-        stop  = { 'line': line + 1, 'col': col }
-        zone = _make_matcher(start, stop)
-        vim.command("let b:checked = matchadd('CheckedByCoq', '%s')" % zone)
-    if len(send_queue) > 0:
-        (l, c) = encountered_dots[-1] if encountered_dots else (0,-1)
-        r = send_queue.pop()
-        send_queue.append(r)
-        (line, col) = r['stop']
-        start = { 'line': l , 'col': c + 1 }
-        stop  = { 'line': line + 1, 'col': col }
-        zone = _make_matcher(start, stop)
-        vim.command("let b:sent = matchadd('SentToCoq', '%s')" % zone)
-    if error_at:
-        ((sline, scol), (eline, ecol)) = error_at
-        start = { 'line': sline + 1, 'col': scol }
-        stop  = { 'line': eline + 1, 'col': ecol }
-        zone = _make_matcher(start, stop)
-        vim.command("let b:errors = matchadd('CoqError', '%s')" % zone)
-        error_at = None
-
-def rewind_to(line, col):
-    if coqtop is None:
+def reset_color(session):
+    """
+    Highlights what Coq checked, what it is still checking, and the last
+    error. Only what changed since the last time is redone, see
+    [PropHighlighter].
+    """
+    # The highlighting of the other buffers is redone when they are entered,
+    # see [buffer_entered].
+    if not _is_current(session):
+        return
+    context = contexts.current()
+    if session.highlighter is None:
+        session.highlighter = make_highlighter(context, session.bufnr)
+    encountered_dots = session.encountered_dots
+    send_queue = session.send_queue
+    zones = {}
+    checked = session.committed()
+    checked_end = encountered_dots[checked - 1] if checked else (0, 0)
+    if checked:
+        zones['CheckedByCoq'] = ((0, 0), checked_end)
+    if send_queue:
+        (line, col) = send_queue[-1]['stop']
+        zones['SentToCoq'] = (checked_end, (line, col + 1))
+    elif session.speculative:
+        zones['SentToCoq'] = (checked_end, encountered_dots[-1])
+    if session.error_at:
+        zones['CoqError'] = session.error_at
+        session.error_at = None
+    # Only the last highlighting of the command matters.
+    context.defer(('highlight', session.bufnr),
+                  partial(session.highlighter.show, context, zones))
+
+def _rewind_to(session, line, col, refresh_after=True):
+    if session.coqtop is None:
         print('Internal error: vimbufsync is still being called but coqtop\
                 appears to be down.')
         print('Please report.')
         return
 
-    predicate = lambda x: x <= (line, col)
-    lst = filter(predicate, encountered_dots)
-    steps = len(encountered_dots) - len(lst)
-    coq_rewind(steps)
+    _rewind(session, session.encountered_dots.states_until((line, col)),
+            refresh_after)
 
 #############################
 # Communication with Coqtop #
 #############################
 
-def send_until_fail():
+def send_until_fail(session):
     """
     Tries to send every message in [send_queue] to Coq, stops at the first
     error.
-    When this function returns, [send_queue] is empty.
+    Up to [g:coquille_pipeline_depth] messages are sent before waiting for the
+    answer to the first one; whatever was accepted after an error is rewound.
+    The messages which were accepted in a previous session (see
+    [CheckpointCache]) are all sent at once, without redrawing in between.
+    When this function returns, [send_queue] is empty, unless we are in
+    asynchronous mode ([g:coquille_async]): the answers are then processed
+    from [poll], as they arrive.
     """
-    global encountered_dots, error_at
+    if session.in_flight:
+        # An asynchronous batch is still running, it will take care of what
+        # has been added to [send_queue].
+        return
+    if not _settle(session):
+        session.send_queue.clear()
+        return
+
+    session.info.start()
+    context = contexts.current()
+    encoding = context.option('fileencoding') or "utf-8"
+    depth = max(1, int(context.option('pipeline_depth')))
 
-    encoding = vim.eval('&fileencoding') or "utf-8"
+    (cached, checkpoint) = _cached_run(session, encoding)
+
+    if _is_async():
+        _fill_pipeline(session, encoding, max(depth, cached),
+                       partial(_on_answer, session))
+        if session.in_flight:
+            if checkpoint is not None:
+                _preview(session, checkpoint)
+            reset_color(session)
+        else:
+            _batch_done(session)
+        return
+
+    nb_answers = 0
+    while len(session.send_queue) > 0:
+        if nb_answers >= cached and (nb_answers - cached) % depth == 0:
+            reset_color(session)
+            # Shows the messages received so far as well.
+            panels.flush()
+            context.redraw()
+            context.flush()
+
+        _fill_pipeline(session, encoding, max(depth, cached - nb_answers))
+        (_, future) = session.in_flight[0]
+        result = session.coqtop.wait(future)
+        nb_answers += 1
+        if not _process_answer(session, result):
+            return
 
-    all_messages = []
-    while len(send_queue) > 0:
-        reset_color()
-        vim.command('redraw')
+    _batch_done(session)
 
-        command_range = send_queue.popleft()
-        command = _between(command_range['start'], command_range['stop'])
+def _fill_pipeline(session, encoding, depth, callback=None):
+    """
+    Sends the first [depth] elements of [send_queue] to coqtop, all at once.
+    """
+    in_flight = session.in_flight
+    send_queue = session.send_queue
+    coqtop = session.coqtop
+    with coqtop.batch():
+        while len(in_flight) < min(depth, len(send_queue)):
+            command_range = send_queue[len(in_flight)]
+            command = _between(session, command_range['start'],
+                               command_range['stop'])
+            command = command.decode(encoding)
+            in_flight.append((command, coqtop.send_interp(
+                command, callback=callback)))
+            if command_range.get('speculative'):
+                # Ask for the goals right away, coqtop will be further away by
+                # the time the user wants to see them.
+                state = len(session.encountered_dots) + len(in_flight)
+                session.prefetched_goals[state] = coqtop.send_goals(
+                    partial(_on_prefetched_goals, session, state))
+
+def _cached_run(session, encoding):
+    """
+    Returns how many messages at the start of [send_queue] were accepted in a
+    previous session, and the checkpoint of the last one.
+    """
+    checkpoints = session.checkpoints
+    if checkpoints is None:
+        return (0, None)
+    encountered_dots = session.encountered_dots
+    prefix = encountered_dots.prefixes[-1] if encountered_dots else ''
+    (count, last) = (0, None)
+    for command_range in session.send_queue:
+        command = _between(session, command_range['start'],
+                           command_range['stop'])
         command = command.decode(encoding)
-        (messages, response) = coqtop.interp(command)
-        all_messages += messages
+        prefix = prefix_digest(prefix, sentence_digest(command))
+        checkpoint = checkpoints.get(prefix)
+        if checkpoint is None:
+            break
+        (count, last) = (count + 1, checkpoint)
+    return (count, last)
+
+def _preview(session, checkpoint):
+    """
+    Shows what coqtop answered last time it reached [checkpoint], while it
+    gets there again.
+    """
+    if not _is_current(session):
+        return
+    handle_messages(session, checkpoint.messages)
+    # The actual answers replace the preview as they arrive.
+    session.info.start()
+    if checkpoint.goals_known and panels.visible(panels.goals):
+        _display_goals(checkpoint.goals, None)
+
+def _process_answer(session, result):
+    """
+    Handles the answer to the oldest command of [in_flight].
+    Returns False if coqtop died, in which case the session is over.
+    """
+    (messages, response) = result
+    command_range = session.send_queue.popleft()
+    (command, _) = session.in_flight.popleft()
+    speculative = command_range.get('speculative')
+    if speculative:
+        state = len(session.encountered_dots) + 1
+        session.prefetched_messages[state] = messages
+    else:
+        handle_messages(session, messages)
+
+    if response is None and not session.coqtop.alive():
+        _coqtop_died(session)
+        return False
+    # Otherwise coqtop was given up on if there is no response: it failed, as
+    # far as we are concerned (see [_settle]).
+    (ok, err) = response or (False, None)
+    if ok:
+        (eline, ecol) = command_range['stop']
+        _infer_goals(session, command)
+        session.encountered_dots.append((eline, ecol + 1),
+                                        digest=sentence_digest(command),
+                                        opens=_will_be_collapsed(command),
+                                        closes=_time_to_collapse(command))
+        session.state_changed()
+        if speculative:
+            session.speculative += 1
+        _save_checkpoint(session, messages)
+    else:
+        if session.checkpoints is not None:
+            prefix = session.encountered_dots.next_prefix(
+                sentence_digest(command))
+            session.checkpoints.discard(prefix)
+        session.send_queue.clear()
+        session.prefetched_messages.pop(len(session.encountered_dots) + 1, None)
+        session.prefetch_error = command_range['stop']
+        if speculative:
+            # The user will see the error when getting there.
+            pass
+        elif err is not None:
+            session.error_at = _error_range(session, command_range['start'],
+                                            err)
+        else:
+            # Nothing tells where the error is: the whole sentence is.
+            (eline, ecol) = command_range['stop']
+            session.error_at = (command_range['start'], (eline, ecol + 1))
+            if response is None:
+                handle_messages(session, [('error', "coqtop took too long to "
+                                           "answer, and was interrupted.")])
+        if not _cancel_in_flight(session):
+            return False
+    return True
+
+def _save_checkpoint(session, messages):
+    """
+    Records that Coq accepted the last message, along with its [messages].
+    If it already did in a previous session, its goals are known.
+    """
+    checkpoints = session.checkpoints
+    if checkpoints is None:
+        return
+    state = len(session.encountered_dots)
+    prefix = session.encountered_dots.prefixes[-1]
+    checkpoint = checkpoints.get(prefix)
+    if checkpoint is not None and checkpoint.goals_known \
+            and state not in session.goal_cache:
+        _cache_goals(session, state, checkpoint.goals)
+    checkpoints.accepted(prefix, messages)
+    if state in session.goal_cache:
+        checkpoints.set_goals(prefix, session.goal_cache[state])
+
+def _cancel_in_flight(session):
+    """
+    Reads the answers to the commands which were sent after a failing one,
+    and rewinds the ones Coq accepted (see [_settle]).
+    In asynchronous mode they aren't waited for: coqtop is interrupted, and
+    [poll] settles them as they arrive.
+    Returns False if coqtop died in the meantime, in which case the session is
+    over.
+    """
+    cancelled = list(session.in_flight)
+    session.in_flight.clear()
+    if not cancelled:
+        return True
 
+    coqtop = session.coqtop
+    if _is_async():
+        for (_, future) in cancelled:
+            coqtop.abandon(future)
+        if not coqtop.poll():
+            _coqtop_died(session)
+            return False
+        if coqtop.orphans():
+            coqtop.interrupt()
+            session.settling = True
+            return True
+        return _settle(session) or session.coqtop is not None
+
+    for (_, future) in cancelled:
+        (_, response) = coqtop.wait(future)
         if response is None:
-            vim.command("call coquille#KillSession()")
-            print('ERROR: the Coq process died')
-            handle_messages(all_messages)
-            return
-        (ok, err) = response
+            if not coqtop.alive():
+                _coqtop_died(session)
+                return False
+            # Counted in [strays] if it is accepted in the end.
+            continue
+        (ok, _) = response
         if ok:
-            (eline, ecol) = command_range['stop']
-            encountered_dots.append((eline, ecol + 1))
-        else:
-            send_queue.clear()
-            loc_s, loc_e = err
-            (l, c) = command_range['start']
-            (l_start, c_start) = _pos_from_offset(c, command, loc_s)
-            (l_stop, c_stop)   = _pos_from_offset(c, command, loc_e)
-            error_at = ((l + l_start, c_start), (l + l_stop, c_stop))
-
-    handle_messages(all_messages)
-    refresh()
-
-def _pos_from_offset(col, msg, offset):
-    str = msg[:offset]
-    lst = str.split('\n')
-    line = len(lst) - 1
-    col = len(lst[-1]) + (col if line == 0 else 0)
-    return (line, col)
+            coqtop.strays += 1
+
+    # If coqtop is still busy, the strays are rewound later on.
+    return _settle(session) or session.coqtop is not None
+
+def _settle(session):
+    """
+    Makes sure coqtop is in the state [encountered_dots] says: waits for the
+    answers to the calls it was given up on, and rewinds the [strays], i.e.
+    the sentences it accepted although we didn't record them.
+    Returns False if it can't, because coqtop is still busy, died, or couldn't
+    be launched.
+    """
+    coqtop = session.coqtop
+    if coqtop is None:
+        print("Error: Coqtop isn't running. Are you sure you called :CoqLaunch?")
+        return False
+    if coqtop.drain() and coqtop.strays:
+        (strays, coqtop.strays) = (coqtop.strays, 0)
+        (_, additional_steps) = coqtop.rewind(strays)
+        if additional_steps is None:
+            _coqtop_died(session)
+            return False
+        # A stray might have closed a proof, which is then rewound as a
+        # whole.
+        _forget_states(session, additional_steps)
+    if not coqtop.alive():
+        _coqtop_died(session)
+        return False
+    if coqtop.strays or coqtop.orphans():
+        print("ERROR: coqtop is still busy with a sentence it was "
+              "interrupted on, try again later (or :CoqKill it)")
+        return False
+    session.settling = False
+    return True
+
+def _on_answer(session, future):
+    """ Callback of the commands sent in asynchronous mode. """
+    in_flight = session.in_flight
+    if not in_flight or in_flight[0][1] is not future:
+        # This command has been cancelled, see [_cancel_in_flight].
+        return
+    if not _process_answer(session, future.result):
+        return
+    if len(session.send_queue) > len(in_flight) and \
+            _edited_before(session, session.send_queue[-1]['stop']):
+        # The sentences not sent yet might have moved: the batch stops there,
+        # the next [sync] takes care of what was sent.
+        while len(session.send_queue) > len(in_flight):
+            session.send_queue.pop()
+    if len(session.send_queue) > len(in_flight):
+        context = contexts.current()
+        encoding = context.option('fileencoding') or "utf-8"
+        depth = max(1, int(context.option('pipeline_depth')))
+        _fill_pipeline(session, encoding, depth, partial(_on_answer, session))
+        reset_color(session)
+    elif in_flight or session.settling:
+        # See [poll] for the latter.
+        reset_color(session)
+    else:
+        _batch_done(session)
+
+def _finish_async(session):
+    """
+    Stops the asynchronous [send_until_fail] in progress, if any: the commands
+    which weren't sent yet are dropped and coqtop is interrupted. When this
+    function returns, the answers to the commands already sent have been
+    processed.
+    """
+    in_flight = session.in_flight
+    if not in_flight:
+        return
+    coqtop = session.coqtop
+    coqtop.poll()
+    while len(session.send_queue) > len(in_flight):
+        session.send_queue.pop()
+    if not in_flight:
+        return
+    coqtop.interrupt()
+    while in_flight:
+        (_, future) = in_flight[0]
+        # [_on_answer] takes care of the answer.
+        coqtop.wait(future)
+        if not future.done:
+            _coqtop_died(session)
+            return
+    # That error was most likely caused by the interruption.
+    session.prefetch_error = None
+
+def _batch_done(session):
+    refresh(session)
+    if session.move_when_done:
+        session.move_when_done = False
+        _goto_last_sent_dot(session)
+    _prefetch(session)
+
+######################
+# Speculative checks #
+######################
+
+def _prefetch(session):
+    """
+    Sends the [g:coquille_prefetch] sentences following the ones the user
+    asked for, in asynchronous mode: they are checked while the user reads
+    the goals, and [_commit]ted when the user gets there.
+    """
+    if not _is_async() or session.coqtop is None:
+        return
+    ahead = int(contexts.current().option('prefetch'))
+    ahead -= session.speculative + sum(1 for r in session.send_queue
+                                       if r.get('speculative'))
+    pos = _last_position(session)
+    if _edited_before(session, pos):
+        return
+    while ahead > 0:
+        r = _get_message_range(session, pos)
+        if r is None or (session.prefetch_error is not None and
+                         r['stop'] >= session.prefetch_error):
+            break
+        r['speculative'] = True
+        session.send_queue.append(r)
+        pos = (r['stop'][0], r['stop'][1] + 1)
+        ahead -= 1
+    if session.send_queue and not session.in_flight:
+        send_until_fail(session)
+
+def _commit(session, limit=None):
+    """
+    The user moves on to the sentences which were sent speculatively and end
+    before [limit] (just the first one if no limit is given).
+    Returns how many of them there were.
+    """
+    encountered_dots = session.encountered_dots
+    messages = []
+    nb_committed = 0
+    while session.speculative:
+        state = session.committed()
+        (line, col) = encountered_dots[state]
+        if (limit is None and nb_committed) or \
+                (limit is not None and (line, col - 1) > limit):
+            break
+        session.speculative -= 1
+        messages.extend(session.prefetched_messages.pop(state + 1, []))
+        nb_committed += 1
+    for r in session.send_queue:
+        if session.speculative or (limit is None and nb_committed):
+            break
+        if not r.get('speculative'):
+            continue
+        if limit is not None and r['stop'] > limit:
+            break
+        # Processed as usual from now on.
+        r['speculative'] = False
+        nb_committed += 1
+    if nb_committed:
+        session.info.start()
+        handle_messages(session, messages)
+    return nb_committed
+
+def _committed(session):
+    """ Shows the state the user moved on to with [_commit]. """
+    # What the user sees changed, even if coqtop's state didn't.
+    session.state_changed()
+    refresh(session)
+    _prefetch(session)
+
+def _is_speculating(session):
+    return session.speculative > 0 or \
+        any(r.get('speculative') for r in session.send_queue)
+
+def _on_prefetched_goals(session, state, future):
+    session.prefetched_goals.pop(state, None)
+    (_, goals) = future.result
+    # Otherwise the sentence leading to [state] wasn't accepted, and the
+    # goals are the ones of another state.
+    if len(session.encountered_dots) == state:
+        _cache_goals(session, state, goals)
+
+def _coqtop_died(session):
+    session.in_flight.clear()
+    session.send_queue.clear()
+    alive = session.coqtop.alive()
+    _kill_session(session)
+    if alive:
+        print('ERROR: the Coq process stopped responding')
+    else:
+        print('ERROR: the Coq process died')
+
+def _kill_session(session):
+    contexts.current().command_now("call coquille#KillSession(%d)"
+                                   % session.bufnr)
+
+def _is_async():
+    context = contexts.current()
+    return (context.option('async') == 'true' and
+            context.option('timers') == '1')
+
+def _auto_move():
+    return contexts.current().option('auto_move') == 'true'
 
 #################
 # Miscellaneous #
 #################
-def _between(begin, end):
+
+def _current():
+    """
+    Returns the session of the current buffer, starting its coqtop again if
+    it had to be stopped, or None if Coquille wasn't launched in it.
+    """
+    session = sessions.get(_current_bufnr())
+    if session is not None and session.coqtop is None:
+        _start(session)
+    return session
+
+def _current_bufnr():
+    return int(contexts.current().option('bufnr'))
+
+def _is_current(session):
+    return session.bufnr == _current_bufnr()
+
+def _offsets(session):
+    """ The [LineOffsets] of the buffer of [session], in its encoding. """
+    session.offsets.use_encoding(
+        contexts.current().option('fileencoding') or "utf-8")
+    return session.offsets
+
+def _between(session, begin, end):
     """
     Returns a string corresponding to the portion of the buffer between the
     [begin] and [end] positions.
     """
-    (bline, bcol) = begin
-    (eline, ecol) = end
-    buf = vim.current.buffer
-    acc = ""
-    for line, str in enumerate(buf[bline:eline + 1]):
-        start = bcol if line == 0 else 0
-        stop  = ecol + 1 if line == eline - bline else len(str)
-        acc += str[start:stop] + '\n'
-    return acc
-
-def _get_message_range(after):
-    """ See [_find_next_chunk] """
-    (line, col) = after
-    end_pos = _find_next_chunk(line, col)
-    return { 'start':after , 'stop':end_pos } if end_pos is not None else None
+    return _offsets(session).text(contexts.current().lines(session.bufnr),
+                                  begin, end)
 
-def _find_next_chunk(line, col):
+def _error_range(session, start, err):
     """
-    Returns the position of the next chunk dot after a certain position.
-    That can either be a bullet if we are in a proof, or "a string" terminated
-    by a dot (outside of a comment, and not denoting a path).
+    The positions of the error [err] coqtop found in the sentence starting at
+    [start]: its location is in bytes from the start of the sentence.
+    """
+    (loc_s, loc_e) = err
+    lines = contexts.current().lines(session.bufnr)
+    offsets = _offsets(session)
+    offset = offsets.offset(lines, start)
+    return (offsets.position(lines, offset + loc_s),
+            offsets.position(lines, offset + loc_e))
+
+def _forget_states(session, nb_removed):
+    """ Forgets about the last [nb_removed] states of coqtop. """
+    if nb_removed <= 0:
+        return
+    session.state_changed()
+    session.speculative = max(0, session.speculative - nb_removed)
+    encountered_dots = session.encountered_dots
+    encountered_dots.truncate(len(encountered_dots) - nb_removed)
+    for cache in (session.goal_cache, session.prefetched_messages):
+        for state in list(cache):
+            if state > len(encountered_dots):
+                del cache[state]
+
+def _checked_position(session):
+    """
+    Returns the position where the next command the user would ask for
+    starts: the speculative ones don't count.
     """
-    buff = vim.current.buffer
-    blen = len(buff)
-    bullets = ['{', '}', '-', '+', '*']
-    # We start by striping all whitespaces (including \n) from the beginning of
-    # the chunk.
-    while line < blen and buff[line][col:].strip() == '':
-        line += 1
-        col = 0
-
-    if line >= blen: return
-
-    while buff[line][col] == ' ': # FIXME: keeping the stripped line would be
-        col += 1                  #   more efficient.
-
-    # Then we check if the first character of the chunk is a bullet.
-    # Intially I did that only when I was sure to be in a proof (by looking in
-    # [encountered_dots] whether I was after a "collapsable" chunk or not), but
-    #   1/ that didn't play well with coq_to_cursor (as the "collapsable chunk"
-    #      might not have been sent/detected yet).
-    #   2/ The bullet chars can never be used at the *beginning* of a chunk
-    #      outside of a proof. So the check was unecessary.
-    if buff[line][col] in bullets:
+    real = [r for r in session.send_queue if not r.get('speculative')]
+    if real:
+        (line, col) = real[-1]['stop']
         return (line, col + 1)
+    checked = session.committed()
+    return session.encountered_dots[checked - 1] if checked else (0,0)
 
-    # We might have a commentary before the bullet, we should be skiping it and
-    # keep on looking.
-    tail_len = len(buff[line]) - col
-    if (tail_len - 1 > 0) and buff[line][col] == '(' and buff[line][col + 1] == '*':
-        com_end = _skip_comment(line, col + 2, 1)
-        if not com_end: return
-        (line, col) = com_end
-        return _find_next_chunk(line, col)
-
-
-    # If the chunk doesn't start with a bullet, we look for a dot.
-    return _find_dot_after(line, col)
-
-def _find_dot_after(line, col):
-    """
-    Returns the position of the next "valid" dot after a certain position.
-    Valid here means: recognized by Coq as terminating an input, so dots in
-    comments, strings or ident paths are not valid.
-    """
-    b = vim.current.buffer
-    if line >= len(b): return
-    s = b[line][col:]
-    dot_pos = s.find('.')
-    com_pos = s.find('(*')
-    str_pos = s.find('"')
-    if com_pos == -1 and dot_pos == -1 and str_pos == -1:
-        # Nothing on this line
-        return _find_dot_after(line + 1, 0)
-    elif dot_pos == -1 or (com_pos > - 1 and dot_pos > com_pos) or (str_pos > - 1 and dot_pos > str_pos):
-        if str_pos == -1 or (com_pos > -1 and str_pos > com_pos):
-            # We see a comment opening before the next dot
-            com_end = _skip_comment(line, com_pos + 2 + col, 1)
-            if not com_end: return
-            (line, col) = com_end
-            return _find_dot_after(line, col)
-        else:
-            # We see a string starting before the next dot
-            str_end = _skip_str(line, str_pos + col + 1)
-            if not str_end: return
-            (line, col) = str_end
-            return _find_dot_after(line, col)
-    elif dot_pos < len(s) - 1 and s[dot_pos + 1] != ' ':
-        # Sometimes dot are used to access module fields, we don't want to stop
-        # just after the module name.
-        # Example: [Require Import Coq.Arith]
-        return _find_dot_after(line, col + dot_pos + 1)
-    elif dot_pos + col > 0 and b[line][col + dot_pos - 1] == '.':
-        # FIXME? There might be a cleaner way to express this.
-        # We don't want to capture ".."
-        if dot_pos + col > 1 and b[line][col + dot_pos - 2] == '.':
-            # But we want to capture "..."
-            return (line, dot_pos + col)
-        else:
-            return _find_dot_after(line, col + dot_pos + 1)
-    else:
-        return (line, dot_pos + col)
+def _last_position(session):
+    """ Returns the position where the next command to send to Coq starts. """
+    if session.send_queue:
+        (line, col) = session.send_queue[-1]['stop']
+        return (line, col + 1)
+    encountered_dots = session.encountered_dots
+    return encountered_dots[-1] if encountered_dots else (0,0)
 
-# TODO? factorize [_skip_str] and [_skip_comment]
-def _skip_str(line, col):
+def _get_message_range(session, after):
     """
-    Used when we encountered the start of a string before a valid dot (see
-    [_find_dot_after]).
-    Returns the position of the end of the string.
+    Returns the range of the next chunk after a certain position.
+    That can either be a bullet if we are in a proof, or "a string" terminated
+    by a dot (outside of a comment, and not denoting a path).
+    See [SentenceIndex].
     """
-    b = vim.current.buffer
-    if line >= len(b): return
-    s = b[line][col:]
-    str_end = s.find('"')
-    if str_end > -1:
-        return (line, col + str_end + 1)
-    else:
-        return _skip_str(line + 1, 0)
-
-def _skip_comment(line, col, nb_left):
-    """
-    Used when we encountered the start of a comment before a valid dot (see
-    [_find_dot_after]).
-    Returns the position of the end of the comment.
-    """
-    if nb_left == 0:
-        return (line, col)
-
-    b = vim.current.buffer
-    if line >= len(b): return
-    s = b[line][col:]
-    com_start = s.find('(*')
-    com_end = s.find('*)')
-    if com_end > -1 and (com_end < com_start or com_start == -1):
-        return _skip_comment(line, col + com_end + 2, nb_left - 1)
-    elif com_start > -1:
-        return _skip_comment(line, col + com_start + 2, nb_left + 1)
-    else:
-        return _skip_comment(line + 1, 0, nb_left)
+    (line, col) = after
+    end_pos = session.sentences.next_chunk(
+        contexts.current().lines(session.bufnr), line, col)
+    return { 'start':after , 'stop':end_pos } if end_pos is not None else None
 
 def _will_be_collapsed(s):
     """
@@ -489,52 +1159,30 @@ def _will_be_collapsed(s):
     proof (returning the "actual" number of steps rewinded).
     We could just rewind one step at a time until we reach the desired point in
     the buffer, but this seems more efficient.
+    The comments of [s] don't count.
     """
-    if re.match(".*(Theorem|Goal|Lemma|Next Obligation).*", s):
+    s = normalize(s)
+    if re.search(r"\b(Theorem|Goal|Lemma|Remark|Fact|Corollary|Proposition"
+                 r"|Example|Next Obligation)\b", s):
         return True
-    elif re.match('.*Definition .*', s) and not re.search(':=', s):
+    elif re.search(r'\bDefinition\s', s) and not re.search(':=', s):
         return True
     else:
         return False
 
+def _may_start_proof(s):
+    """
+    Conservative: has to return True for anything which could open a proof
+    (or obligations), wrongly returning True only costs a goal query.
+    """
+    return _PROOF_STARTERS.search(normalize(s)) is not None
+
+_PROOF_STARTERS = re.compile(
+    r'\b(Theorem|Lemma|Remark|Fact|Corollary|Proposition|Property|Definition'
+    r'|Example|Fixpoint|CoFixpoint|Let|Instance|Program|Goal|Obligations?'
+    r'|Function|Add|Derive|Equations|Morphism|Proof|Include|Declare|Context)\b')
+
 def _time_to_collapse(s):
     """ Used in conjunction with [_will_be_collapsed] """
-    return True if re.match('.*(Qed|Defined)\.$', s) else False
-
-## I thought python was the language with a big stdlib...
-def rfind(lst, cond):
-    tmp = None
-    for idx, elt in enumerate(lst):
-        if cond(elt): tmp = idx
-    return tmp
-
-################################################
-# The ugly through behind regions highlighting #
-################################################
-
-def _make_matcher(start, stop):
-    if start['line'] == stop['line']:
-        return _easy_matcher(start, stop)
-    else:
-        return _hard_matcher(start, stop)
-
-def _easy_matcher(start, stop):
-    startl = ""
-    startc = ""
-    if start['line'] > 0:
-        startl = "\%>{0}l".format(start['line'] - 1)
-    if start['col'] > 0:
-        startc = "\%>{0}c".format(start['col'])
-    return '{0}{1}\%<{2}l\%<{3}c'.format(startl, startc, stop['line'] + 1, stop['col'] + 1)
-
-def _hard_matcher(start, stop):
-    first_start = {'line' : start['line'], 'col' : start['col']}
-    first_stop =  {'line' : start['line'], 'col' : 4242}
-    first_line = _easy_matcher(first_start, first_stop)
-    mid_start = {'line' : start['line']+1, 'col' : 0}
-    mid_stop =  {'line' : stop['line']-1 , 'col' : 4242}
-    middle = _easy_matcher(mid_start, mid_stop)
-    last_start = {'line' : stop['line'], 'col' : 0}
-    last_stop =  {'line' : stop['line'], 'col' : stop['col']}
-    last_line = _easy_matcher(last_start, last_stop)
-    return "{0}\|{1}\|{2}".format(first_line, middle, last_line)
+    return True if re.search(r'\b(Qed|Defined|Admitted)\.$', normalize(s)) \
+        else False
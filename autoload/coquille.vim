@@ -1,4 +1,3 @@
-let s:coq_running=0
 let s:current_dir=expand("<sfile>:p:h") 
 
 if !exists('coquille_auto_move')
@@ -9,6 +8,46 @@ if !exists('g:coquille_coqtop_path')
     let g:coquille_coqtop_path="coqtop"
 endif
 
+if !exists('g:coquille_pipeline_depth')
+    let g:coquille_pipeline_depth=1
+endif
+
+if !exists('g:coquille_timeouts')
+    let g:coquille_timeouts={}
+endif
+
+if !exists('g:coquille_async')
+    let g:coquille_async="false"
+endif
+
+if !exists('g:coquille_cache_dir')
+    let g:coquille_cache_dir=""
+endif
+
+if !exists('g:coquille_max_sessions')
+    let g:coquille_max_sessions=4
+endif
+
+if !exists('g:coquille_prefetch')
+    let g:coquille_prefetch=0
+endif
+
+if !exists('g:coquille_message_levels')
+    let g:coquille_message_levels=['debug', 'info', 'notice', 'warning', 'error']
+endif
+
+if !exists('g:coquille_info_size')
+    let g:coquille_info_size=1000
+endif
+
+if !exists('g:coquille_trace_file')
+    let g:coquille_trace_file=""
+endif
+
+if !exists('g:coquille_build_deps')
+    let g:coquille_build_deps="false"
+endif
+
 " Load vimbufsync if not already done
 call vimbufsync#init()
 
@@ -29,22 +68,40 @@ function! coquille#ShowPanels()
         setlocal noswapfile
         let s:info_buf = bufnr("%")
     execute l:winnb . 'winc w'
+    py coquille.panels.register(int(vim.eval("s:goal_buf")),
+\                               int(vim.eval("s:info_buf")))
 endfunction
 
-function! coquille#KillSession()
-    let s:coq_running = 0
-
-    execute 'bdelete' . s:goal_buf
-    execute 'bdelete' . s:info_buf
-    py coquille.kill_coqtop()
-
-    setlocal ei=InsertEnter
+" Kills the session of the given buffer (the current one by default). The
+" panels are closed with the last session.
+function! coquille#KillSession(...)
+    let l:buf = a:0 ? a:1 : bufnr("%")
+    call setbufvar(l:buf, 'coq_running', 0)
+    execute 'au! InsertEnter <buffer=' . l:buf . '>'
+    execute 'au! BufEnter <buffer=' . l:buf . '>'
+
+    py coquille.kill_coqtop(int(vim.eval("l:buf")))
+
+    if pyeval('len(coquille.sessions)') == 0
+        if exists('s:poll_timer')
+            call timer_stop(s:poll_timer)
+            unlet s:poll_timer
+        endif
+
+        py coquille.panels.unregister()
+        execute 'bdelete' . s:goal_buf
+        execute 'bdelete' . s:info_buf
+    endif
 endfunction
 
 function! coquille#RawQuery(...)
     py coquille.coq_raw_query(*vim.eval("a:000"))
 endfunction
 
+function! coquille#Poll(timer)
+    py coquille.poll()
+endfunction
+
 function! coquille#FNMapping()
     "" --- Function keys bindings
     "" Works under all tested config.
@@ -73,10 +130,10 @@ function! coquille#CoqideMapping()
 endfunction
 
 function! coquille#Launch(...)
-    if s:coq_running == 1
+    if get(b:, 'coq_running', 0) == 1
         echo "Coq is already running"
     else
-        let s:coq_running = 1
+        let b:coq_running = 1
 
         " initialize the plugin (launch coqtop)
         py coquille.launch_coq(*vim.eval("map(copy(a:000),'expand(v:val)')"))
@@ -87,10 +144,21 @@ function! coquille#Launch(...)
         command! -buffer CoqUndo py coquille.coq_rewind()
         command! -buffer CoqToCursor py coquille.coq_to_cursor()
         command! -buffer CoqKill call coquille#KillSession()
+        command! -buffer CoqInterrupt py coquille.coq_interrupt()
+        command! -buffer CoqStats py coquille.print_stats()
 
         command! -buffer -nargs=* Coq call coquille#RawQuery(<f-args>)
 
-        call coquille#ShowPanels()
+        " The panels are shared by the sessions of every buffer.
+        if !exists('s:goal_buf') || !buflisted(s:goal_buf)
+            call coquille#ShowPanels()
+        endif
+
+        " In asynchronous mode, the answers of coqtop are processed from a
+        " timer instead of blocking vim until they arrive.
+        if g:coquille_async == "true" && has('timers') && !exists('s:poll_timer')
+            let s:poll_timer = timer_start(50, 'coquille#Poll', {'repeat': -1})
+        endif
 
         " Automatically sync the buffer when entering insert mode: this is usefull
         " when we edit the portion of the buffer which has already been sent to coq,
@@ -100,6 +168,12 @@ function! coquille#Launch(...)
         " nothing really problematic will happen, as sync will be called the next
         " time you explicitly call a command (be it 'rewind' or 'interp')
         au InsertEnter <buffer> py coquille.sync()
+        au BufEnter <buffer> py coquille.buffer_entered()
+
+        augroup coquille_checkpoints
+            au!
+            au VimLeavePre * py coquille.save_checkpoints()
+        augroup END
     endif
 endfunction
 
@@ -107,6 +181,17 @@ function! coquille#Register()
     hi CheckedByCoq ctermbg=17 guibg=#564545
     hi SentToCoq ctermbg=60 guibg=#504545
     hi link CoqError Error
+    hi link CoqChangedHyp DiffChange
+
+    if exists('*prop_type_add') && empty(prop_type_get('CoqChangedHyp'))
+        call prop_type_add('CoqChangedHyp', {'highlight': 'CoqChangedHyp'})
+    endif
+    " The zones of the buffers, see highlight.py. Errors are shown on top.
+    if exists('*prop_type_add') && empty(prop_type_get('CheckedByCoq'))
+        call prop_type_add('CheckedByCoq', {'highlight': 'CheckedByCoq'})
+        call prop_type_add('SentToCoq', {'highlight': 'SentToCoq'})
+        call prop_type_add('CoqError', {'highlight': 'CoqError', 'priority': 10})
+    endif
 
     let b:checked = -1
     let b:sent    = -1
@@ -0,0 +1,136 @@
+#: The highlight groups of the zones of a buffer, see [PropHighlighter.show].
+ZONES = ('CheckedByCoq', 'SentToCoq', 'CoqError')
+
+def make_highlighter(context, bufnr):
+    """
+    Returns the best highlighter for buffer [bufnr] this vim supports: text
+    properties if it has them, matches otherwise.
+    """
+    if context.option('textprop') == '1':
+        return PropHighlighter(bufnr)
+    return MatchHighlighter(bufnr)
+
+class PropHighlighter (object):
+    """
+    Highlights the zones of a buffer with text properties.
+
+    Vim doesn't have to evaluate anything on redraw, and the properties follow
+    the text when it is edited. Only what changed since the last call to
+    [show] is updated: when a zone grows, the new part is added to it; when it
+    shrinks, only its lines after the new end are cleared.
+    """
+
+    def __init__(self, bufnr):
+        self.bufnr = bufnr
+        #: The zones currently shown, None if unknown.
+        self.shown = None
+
+    def show(self, context, zones):
+        """
+        Highlights [zones], a dict from the highlight groups of [ZONES] to
+        the (start, stop) positions of their zone (stop excluded), or None.
+        The commands are queued in [context], see [Context].
+        """
+        cmds = []
+        for group in ZONES:
+            new = zones.get(group)
+            if self.shown is None:
+                cmds.append(self._remove(group))
+                cmds.extend(self._add(group, new))
+            elif self.shown.get(group) != new:
+                cmds.extend(self._update(group, self.shown.get(group), new))
+        self.shown = dict(zones)
+        for cmd in cmds:
+            context.command(cmd)
+
+    def edited(self, pos):
+        """
+        The buffer was edited from [pos] onward: the properties after that
+        moved along with the text, so they have to be redone.
+        """
+        if self.shown is not None and any(
+                zone is not None and pos < zone[1]
+                for zone in self.shown.values()):
+            self.shown = None
+
+    def _update(self, group, old, new):
+        if old is not None and new is not None and old[0] == new[0]:
+            (start, stop) = new
+            if stop > old[1]:
+                return self._add(group, (old[1], stop))
+            # Only the part of the last line before the new end stays.
+            line = stop[0]
+            return ([self._remove(group, line, old[1][0])] +
+                    self._add(group, (max(start, (line, 0)), stop)))
+        cmds = []
+        if old is not None:
+            cmds.append(self._remove(group, old[0][0], old[1][0]))
+        return cmds + self._add(group, new)
+
+    def _add(self, group, zone):
+        if zone is None or zone[0] >= zone[1]:
+            return []
+        ((sline, scol), (eline, ecol)) = zone
+        return ["call prop_add(%d, %d, {'type': '%s', 'bufnr': %d, "
+                "'end_lnum': %d, 'end_col': %d})"
+                % (sline + 1, scol + 1, group, self.bufnr, eline + 1, ecol + 1)]
+
+    def _remove(self, group, first=None, last=None):
+        props = "{'type': '%s', 'bufnr': %d, 'all': 1}" % (group, self.bufnr)
+        if first is None:
+            return "call prop_remove(%s)" % props
+        return "call prop_remove(%s, %d, %d)" % (props, first + 1, last + 1)
+
+class MatchHighlighter (object):
+    """
+    Highlights the zones of the current buffer with matches, for vims without
+    text properties. Same interface as [PropHighlighter].
+
+    The ids of the matches are kept in the b:checked, b:sent and b:errors
+    variables.
+    """
+
+    VARIABLES = {
+        'CheckedByCoq': 'b:checked',
+        'SentToCoq':    'b:sent',
+        'CoqError':     'b:errors',
+    }
+
+    def __init__(self, bufnr):
+        self.bufnr = bufnr
+        self.shown = None
+
+    def show(self, context, zones):
+        cmds = []
+        for group in ZONES:
+            new = zones.get(group)
+            if self.shown is not None and self.shown.get(group) == new:
+                continue
+            var = self.VARIABLES[group]
+            cmds.append("if %s != -1 | silent! call matchdelete(%s) | endif"
+                        % (var, var))
+            if new is None or new[0] >= new[1]:
+                cmds.append("let %s = -1" % var)
+            else:
+                cmds.append("let %s = matchadd('%s', '%s')"
+                            % (var, group, _matcher(*new)))
+        self.shown = dict(zones)
+        for cmd in cmds:
+            context.command(cmd)
+
+    def edited(self, pos):
+        # Matches are recomputed by vim on every redraw anyway.
+        pass
+
+def _matcher(start, stop):
+    """
+    A pattern matching every character from [start] to [stop] (excluded).
+    """
+    ((sline, scol), (eline, ecol)) = (start, stop)
+    if sline == eline:
+        return '\\%{0}l\\%>{1}c\\%<{2}c.'.format(sline + 1, scol, ecol + 1)
+    branches = ['\\%{0}l\\%>{1}c.'.format(sline + 1, scol)]
+    if eline > sline + 1:
+        branches.append('\\%>{0}l\\%<{1}l.'.format(sline + 1, eline + 1))
+    branches.append('\\%{0}l\\%<{1}c.'.format(eline + 1, ecol + 1))
+    return '\\|'.join(branches)
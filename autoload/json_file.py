@@ -0,0 +1,33 @@
+"""
+The JSON files the caches persist to, see [CheckpointCache] and [BuildCache].
+"""
+import os
+import json
+import tempfile
+
+def read_json(path, default=None):
+    """ The content of [path], or [default] if it is missing or corrupted. """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+def write_json(path, data):
+    """
+    Writes [data] to [path], creating its directory if needed. Returns False
+    if it couldn't.
+    [data] is written to a temporary file which then replaces [path]: a half
+    written file is never left behind.
+    """
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        (fd, tmp) = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        return False
+    return True
@@ -0,0 +1,56 @@
+from collections import deque
+
+#: The levels of the messages of coqtop, see [CoqTop._parse_message].
+LEVELS = ('debug', 'info', 'notice', 'warning', 'error')
+
+class MessageLog (object):
+    """
+    The messages shown in the Infos panel, one line at a time.
+
+    Only the last [size] lines are kept, so that a huge answer (a big `Print`
+    or `Search`) can't fill the memory nor the panel. The messages of a new
+    command replace the ones of the previous command, but only when the first
+    of them arrives (see [start]): until then, the old ones stay visible.
+    """
+
+    def __init__(self, size=1000):
+        self.lines = deque(maxlen=max(1, size))
+        #: Whether the next message replaces the log.
+        self.starting = False
+
+    def resize(self, size):
+        if size != self.lines.maxlen:
+            self.lines = deque(self.lines, maxlen=max(1, size))
+
+    def start(self):
+        """ A new command begins, its messages will replace the current ones. """
+        self.starting = True
+
+    def clear(self):
+        self.lines.clear()
+        self.starting = False
+
+    def set(self, text):
+        """ Replaces the log with [text]. """
+        self.clear()
+        if text:
+            self.lines.extend(text.split('\n'))
+
+    def add(self, messages, levels=LEVELS):
+        """
+        Appends the [messages] whose level is in [levels], as (level, text)
+        pairs. Returns the new lines, and whether the log was replaced by them
+        rather than extended.
+        """
+        new = []
+        for (level, text) in messages:
+            if text and level in levels:
+                new.extend(text.split('\n'))
+                new.append('')
+        if not new:
+            return ([], False)
+        replaced = self.starting
+        if replaced:
+            self.clear()
+        self.lines.extend(new)
+        return (new, replaced)
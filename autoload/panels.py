@@ -0,0 +1,176 @@
+from contextlib import contextmanager
+
+class Panel (object):
+    """ A scratch buffer Coquille writes to, known by its number. """
+    def __init__(self, number):
+        self.number = number
+        #: What the buffer contains, as far as we know.
+        self.lines = None
+        #: What it should contain once [Panels.flush]ed, if it changed.
+        self.pending = None
+        #: The ranges of lines (first, last) to highlight, see
+        #: [Panels.show_goals].
+        self.highlights = []
+        #: Lines to add at the end of the buffer once [Panels.flush]ed, and
+        #: how many lines it may contain then, see [Panels.append_info].
+        self.appended = []
+        self.size = None
+
+class Panels (object):
+    """
+    The Goals and Infos panels.
+
+    Their buffer numbers are registered once, by coquille#ShowPanels. Writes
+    are only recorded: they are all done at once (with a single redraw) when
+    the outermost [batch] is over, so a panel is written at most once per
+    command no matter how many times its content changes.
+    Vim is reached through the [Context] of the current command, given by
+    [contexts].
+    """
+
+    def __init__(self, contexts):
+        self.goals = None
+        self.infos = None
+        self.contexts = contexts
+        self._depth = 0
+
+    def register(self, goal_buf, info_buf):
+        self.goals = Panel(goal_buf)
+        self.infos = Panel(info_buf)
+
+    def unregister(self):
+        self.goals = None
+        self.infos = None
+
+    def visible(self, panel):
+        return panel is not None and \
+            self.contexts.current().eval('bufwinnr(%d)' % panel.number) != '-1'
+
+    def show_goals(self, lines, highlights):
+        """ Shows [lines] in the Goals panel, and highlights some of them. """
+        if self.goals is not None:
+            self.goals.pending = lines
+            self.goals.highlights = highlights
+            self._written()
+
+    def show_info(self, lines):
+        if self.infos is not None:
+            self.infos.pending = lines
+            self.infos.appended = []
+            self._written()
+
+    def append_info(self, lines, size):
+        """
+        Adds [lines] at the end of the Infos panel, dropping its first lines
+        if it gets longer than [size].
+        """
+        infos = self.infos
+        if infos is None or not lines:
+            return
+        if infos.pending is not None:
+            infos.pending = (infos.pending + lines)[-size:]
+        else:
+            infos.appended.extend(lines)
+            infos.size = size
+        self._written()
+
+    @contextmanager
+    def batch(self):
+        """ Delays the writes to the panels until the end of the block. """
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self.flush()
+
+    def flush(self):
+        """
+        Returns whether anything was written (a redraw is then queued).
+        """
+        context = self.contexts.current()
+        written = [self._write(context, panel)
+                   for panel in (self.goals, self.infos)
+                   if panel is not None and
+                   (panel.pending is not None or panel.appended)]
+        if not any(written):
+            return False
+        context.redraw()
+        return True
+
+    def _written(self):
+        if self._depth == 0:
+            self.flush()
+
+    def _write(self, context, panel):
+        """ Returns False if the buffer of [panel] doesn't exist anymore. """
+        (lines, panel.pending) = (panel.pending, None)
+        (appended, panel.appended) = (panel.appended, [])
+        try:
+            buff = context.buffer(panel.number)
+        except (KeyError, ValueError):
+            return False
+        if lines is None:
+            if panel.lines is not None and panel.lines and \
+                    len(buff) == len(panel.lines):
+                _append_lines(buff, panel.lines, appended, panel.size)
+                return True
+            # We don't know what the buffer contains (or it is empty, and
+            # still has its blank line): rewrite it.
+            lines = ((panel.lines or []) + appended)[-panel.size:]
+        if panel.lines is None or len(buff) != len(panel.lines):
+            buff[:] = lines
+        else:
+            _replace_lines(buff, panel.lines, lines)
+        panel.lines = lines
+        if panel is self.goals:
+            _highlight(context, panel.number, lines, panel.highlights)
+        return True
+
+def _replace_lines(buff, old, new):
+    """
+    Turns the lines [old] of [buff] into [new], only touching the lines which
+    changed.
+    """
+    common = min(len(old), len(new))
+    prefix = 0
+    while prefix < common and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < common - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    if prefix == len(old) == len(new):
+        return
+    buff[prefix:len(old) - suffix] = new[prefix:len(new) - suffix]
+
+#: Lines are appended to a panel by chunks of that size, see [_append_lines].
+APPEND_CHUNK = 500
+
+def _append_lines(buff, lines, new, size):
+    """
+    Appends [new] to [buff], whose content is [lines], and drops its first
+    lines to keep at most [size] of them. [lines] is updated in place.
+    """
+    new = new[-size:]
+    for start in range(0, len(new), APPEND_CHUNK):
+        buff.append(new[start:start + APPEND_CHUNK])
+    lines.extend(new)
+    excess = len(lines) - size
+    if excess > 0:
+        del buff[:excess]
+        del lines[:excess]
+
+def _highlight(context, bufnr, lines, ranges):
+    """
+    Highlights the [ranges] of [lines], the content of buffer [bufnr], as
+    CoqChangedHyp.
+    """
+    if context.option('textprop') != '1':
+        return
+    context.command("call prop_remove({'type': 'CoqChangedHyp', 'bufnr': %d, "
+                    "'all': 1})" % bufnr)
+    for (first, last) in ranges:
+        context.command("call prop_add(%d, 1, {'type': 'CoqChangedHyp', "
+                        "'bufnr': %d, 'end_lnum': %d, 'end_col': %d})"
+                        % (first + 1, bufnr, last + 1, len(lines[last]) + 1))
@@ -0,0 +1,406 @@
+import re
+import codecs
+import hashlib
+
+from bisect import bisect_left, bisect_right
+
+# Characters which, at the *beginning* of a chunk, form a chunk on their own.
+# '-', '+' and '*' can be repeated ("--", "**", ...) to form deeper bullets.
+BULLETS = '{}-+*'
+REPEATABLE_BULLETS = '-+*'
+
+# Interesting positions while scanning, depending on the lexer state.
+_NORMAL_RE  = re.compile(r'\(\*|"|\.')
+_COMMENT_RE = re.compile(r'\(\*|\*\)|"')
+_NON_BLANK  = re.compile(r'\S')
+_BLANKS     = re.compile(r'\s+')
+_CODE_RE    = re.compile(r'\(\*|"')
+
+class SentenceIndex (object):
+    """
+    Positions of the sentence ends ("valid" dots and bullets) of a buffer.
+
+    The buffer is scanned lazily, in a single linear pass, by a small lexer
+    which knows about comments (nested), strings, bullets and dots used in
+    qualified names. Every sentence end found is remembered, so finding the
+    chunk following a given position is just a bisection once the buffer has
+    been scanned that far.
+
+    When the buffer is modified, [invalidate] must be called with the first
+    modified line: only the sentences ending after that line are forgotten.
+    """
+
+    def __init__(self):
+        self.stops = []
+        self._restart()
+
+    def invalidate(self, line=0):
+        """ Forgets every sentence ending on or after [line]. """
+        del self.stops[bisect_left(self.stops, (line, -1)):]
+        self._restart()
+
+    def next_chunk(self, buff, line, col):
+        """
+        Returns the position of the end of the chunk starting at [(line, col)]
+        in [buff] (a sequence of lines), or None if there is no complete chunk
+        after that position.
+        """
+        pos = (line, col)
+        while True:
+            idx = bisect_left(self.stops, pos)
+            if idx < len(self.stops):
+                return self.stops[idx]
+            if not self._scan_next(buff):
+                return None
+
+    def _restart(self):
+        """ Resumes scanning right after the last known sentence. """
+        if self.stops:
+            (line, col) = self.stops[-1]
+            self._pos = (line, col + 1)
+        else:
+            self._pos = (0, 0)
+
+    def _scan_next(self, buff):
+        """
+        Scans [buff] from the current frontier until the end of the next
+        sentence, which is appended to [self.stops].
+        Returns False if the end of the buffer is reached first.
+        """
+        (line, col) = self._pos
+        blen = len(buff)
+        depth = 0        # comment nesting
+        in_str = False   # inside a string (possibly inside a comment)
+        started = False  # seen something which isn't a comment or a blank
+
+        while line < blen:
+            s = buff[line]
+            slen = len(s)
+            while col < slen:
+                if in_str:
+                    end = s.find('"', col)
+                    if end == -1:
+                        break
+                    in_str = False
+                    col = end + 1
+                elif depth > 0:
+                    m = _COMMENT_RE.search(s, col)
+                    if m is None:
+                        break
+                    tok = m.group()
+                    if tok == '(*':
+                        depth += 1
+                    elif tok == '*)':
+                        depth -= 1
+                    else:
+                        in_str = True
+                    col = m.end()
+                elif not started:
+                    m = _NON_BLANK.search(s, col)
+                    if m is None:
+                        break
+                    col = m.start()
+                    c = s[col]
+                    if s.startswith('(*', col):
+                        depth = 1
+                        col += 2
+                    elif c in BULLETS:
+                        stop = col
+                        if c in REPEATABLE_BULLETS:
+                            while stop + 1 < slen and s[stop + 1] == c:
+                                stop += 1
+                        return self._found(line, stop)
+                    else:
+                        started = True
+                else:
+                    m = _NORMAL_RE.search(s, col)
+                    if m is None:
+                        break
+                    tok = m.group()
+                    col = m.end()
+                    if tok == '(*':
+                        depth = 1
+                    elif tok == '"':
+                        in_str = True
+                    elif _is_terminator(s, col - 1):
+                        return self._found(line, col - 1)
+            line += 1
+            col = 0
+
+        # Incomplete sentence: the next scan will start again from the last
+        # known sentence end, since the buffer can grow in the meantime.
+        self._restart()
+        return False
+
+    def _found(self, line, col):
+        self.stops.append((line, col))
+        self._pos = (line, col + 1)
+        return True
+
+class StateIndex (object):
+    """
+    The positions right after the sentences Coq accepted, in order: coqtop is
+    in state n once the n first sentences have been accepted.
+
+    It also records the structure of the proofs: once a proof is closed (by
+    "Qed", "Defined", ...) Coq can't rewind to a state inside of it anymore,
+    only to the state before the proof started. See [keepable].
+
+    Each sentence comes with its [sentence_digest], so that an edit which
+    doesn't change what Coq reads doesn't have to be rewound: see [relocate].
+    """
+
+    def __init__(self):
+        self.ends = []
+        #: For each state, the digest of the sentence which led to it.
+        self.digests = []
+        #: For each state, the digest of all the sentences leading to it, see
+        #: [prefix_digest].
+        self.prefixes = []
+        #: For each state, the first state of the closed proof it belongs to
+        #: (if it does).
+        self.block_start = []
+        #: The last state of each closed proof, indexed by its first one.
+        self.block_end = {}
+        #: For each state, the first states of the proofs still open after it.
+        self.open_after = []
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __iter__(self):
+        return iter(self.ends)
+
+    def __getitem__(self, idx):
+        return self.ends[idx]
+
+    def append(self, pos, digest=None, opens=False, closes=False):
+        """
+        Records a sentence Coq accepted, ending right before [pos], which
+        [opens] and/or [closes] a proof.
+        """
+        state = len(self.ends)
+        opened = self.open_after[-1] if self.open_after else ()
+        self.ends.append(pos)
+        self.digests.append(digest)
+        self.prefixes.append(self.next_prefix(digest))
+        self.block_start.append(None)
+        if opens:
+            opened = opened + (state,)
+        elif closes and opened:
+            start = opened[-1]
+            opened = opened[:-1]
+            self.block_end[start] = state
+            for idx in range(start, state + 1):
+                self.block_start[idx] = start
+        self.open_after.append(opened)
+
+    def next_prefix(self, digest):
+        """ The prefix digest of the state the sentence [digest] leads to. """
+        return prefix_digest(self.prefixes[-1] if self.prefixes else '',
+                             digest)
+
+    def states_until(self, pos):
+        """ The number of sentences ending at or before [pos]. """
+        return bisect_right(self.ends, pos)
+
+    def keepable(self, nb_states):
+        """
+        The number of states left once the ones after the first [nb_states]
+        are rewound: Coq rewinds closed proofs as a whole.
+        """
+        if nb_states == 0 or nb_states >= len(self.ends):
+            return nb_states
+        start = self.block_start[nb_states - 1]
+        if start is not None and self.block_start[nb_states] == start:
+            return start
+        return nb_states
+
+    def steps_to(self, pos):
+        """ How many states have to be rewound to go back to [pos]. """
+        return len(self.ends) - self.keepable(self.states_until(pos))
+
+    def truncate(self, nb_states):
+        """ Only keeps the first [nb_states] states. """
+        del self.ends[nb_states:]
+        del self.digests[nb_states:]
+        del self.prefixes[nb_states:]
+        del self.block_start[nb_states:]
+        del self.open_after[nb_states:]
+        # [block_end] isn't cleaned up: the entries of the forgotten proofs
+        # are overwritten before being read again.
+        if nb_states == 0:
+            return
+        start = self.block_start[-1]
+        if start is not None and self.block_end[start] >= nb_states:
+            # Coq didn't rewind that proof as a whole, so it is open again
+            # (which [keepable] should have prevented). [open_after] already
+            # says so.
+            for idx in range(start, nb_states):
+                self.block_start[idx] = None
+
+    def relocate(self, first, positions):
+        """
+        Moves the ends of the sentences leading to the states following
+        [first] to [positions], after the buffer has been edited around them
+        without changing them.
+        Returns True if any of them actually moved.
+        """
+        last = first + len(positions)
+        if self.ends[first:last] == positions:
+            return False
+        self.ends[first:last] = positions
+        return True
+
+class LineOffsets (object):
+    """
+    Where every line of a buffer starts, counted from the start of the buffer
+    (every line being followed by a newline) in two ways:
+    - in bytes of its UTF-8 encoding, which is how coqtop counts (e.g. the
+      location of an error),
+    - in characters, which is how positions count. These are the indexes in
+      the lines as given, so for the lines vim gives to python 2 (which are
+      bytes in [encoding]) they are actually bytes too.
+
+    Like [SentenceIndex], the offsets are computed lazily, as far as needed,
+    and [invalidate] must be called with the first modified line.
+    """
+
+    def __init__(self, encoding='utf-8'):
+        self.bytes = [0]
+        self.chars = [0]
+        self.encoding = None
+        self.use_encoding(encoding)
+
+    def use_encoding(self, encoding):
+        """ The lines are bytes in [encoding]. """
+        encoding = codecs.lookup(encoding).name
+        if encoding != self.encoding:
+            self.encoding = encoding
+            self.invalidate()
+
+    def invalidate(self, line=0):
+        """ Forgets the offsets of the lines following [line]. """
+        del self.bytes[line + 1:]
+        del self.chars[line + 1:]
+
+    def text(self, lines, begin, end):
+        """
+        The text of [lines] from the position [begin] to [end] (included),
+        followed by a newline.
+        """
+        (bline, bcol) = begin
+        (eline, ecol) = end
+        self._extend(lines, eline)
+        stop = self.chars[eline] - self.chars[bline] + ecol + 1
+        return '\n'.join(lines[bline:eline + 1])[bcol:stop] + '\n'
+
+    def offset(self, lines, pos):
+        """ The offset of the position [pos] of [lines], in bytes. """
+        (line, col) = pos
+        self._extend(lines, line)
+        return self.bytes[line] + self._utf8_len(lines[line][:col])
+
+    def position(self, lines, offset):
+        """
+        The position of [lines] at [offset] bytes (see [offset]), or the end
+        of the last line if there are less of them.
+        """
+        while self.bytes[-1] <= offset and len(self.bytes) <= len(lines):
+            self._extend(lines, len(self.bytes))
+        line = min(bisect_right(self.bytes, offset), len(lines)) - 1
+        if line < 0:
+            return (0, 0)
+        return (line, self._index_of_byte(lines[line],
+                                          offset - self.bytes[line]))
+
+    def _extend(self, lines, line):
+        """ Computes the offsets of the lines until [line] (included). """
+        known = len(self.bytes) - 1
+        for text in lines[known:line]:
+            self.bytes.append(self.bytes[-1] + self._utf8_len(text) + 1)
+            self.chars.append(self.chars[-1] + len(text) + 1)
+
+    def _utf8_len(self, text):
+        if isinstance(text, bytes):
+            if self.encoding == 'utf-8':
+                return len(text)
+            text = text.decode(self.encoding, 'replace')
+        return len(text.encode('utf-8'))
+
+    def _index_of_byte(self, text, offset):
+        """ The index in [text] of its byte at [offset], in UTF-8. """
+        if isinstance(text, bytes):
+            if self.encoding == 'utf-8':
+                return min(offset, len(text))
+            decoded = text.decode(self.encoding, 'replace')
+        else:
+            decoded = text
+        prefix = decoded.encode('utf-8')[:offset].decode('utf-8', 'ignore')
+        if isinstance(text, bytes):
+            return len(prefix.encode(self.encoding, 'replace'))
+        return len(prefix)
+
+def sentence_digest(text):
+    """
+    A digest of what Coq reads in the sentence [text] (a unicode string):
+    comments don't count, neither does the amount of blanks between words.
+    """
+    return hashlib.sha1(normalize(text).encode('utf-8')).hexdigest()
+
+def prefix_digest(previous, digest):
+    """
+    Chains the [sentence_digest] of a sentence to the prefix digest of the
+    sentences before it ('' at the start of the buffer).
+    """
+    return hashlib.sha1((previous + (digest or '')).encode('ascii')).hexdigest()
+
+def normalize(text):
+    """
+    Removes the comments of [text] and collapses its blanks, except the ones
+    inside of strings.
+    """
+    pieces = []
+    plain = []  # what was seen since the last string
+    pos = 0
+    depth = 0
+    while True:
+        m = (_CODE_RE if depth == 0 else _COMMENT_RE).search(text, pos)
+        if m is None:
+            if depth == 0:
+                plain.append(text[pos:])
+            break
+        tok = m.group()
+        if depth == 0:
+            plain.append(text[pos:m.start()])
+        if tok == '"':
+            end = text.find('"', m.end())
+            end = len(text) if end == -1 else end + 1
+            if depth == 0:
+                pieces.append(_BLANKS.sub(' ', ''.join(plain)))
+                pieces.append(text[m.start():end])
+                plain = []
+            pos = end
+            continue
+        if tok == '(*':
+            if depth == 0:
+                # A comment separates words, just like a blank.
+                plain.append(' ')
+            depth += 1
+        else:
+            depth -= 1
+        pos = m.end()
+    pieces.append(_BLANKS.sub(' ', ''.join(plain)))
+    return ''.join(pieces).strip()
+
+def _is_terminator(s, dot):
+    """
+    Is the dot at index [dot] of [s] recognized by Coq as terminating an input?
+    Dots used to access module fields (e.g. [Require Import Coq.Arith]) are
+    not, neither are ".." (but "..." is).
+    """
+    if dot + 1 < len(s) and not s[dot + 1].isspace():
+        return False
+    if dot > 0 and s[dot - 1] == '.':
+        return dot > 1 and s[dot - 2] == '.'
+    return True
@@ -0,0 +1,150 @@
+import itertools
+
+from collections import deque, OrderedDict
+
+from message_log import MessageLog
+from sentence_index import LineOffsets, SentenceIndex, StateIndex
+
+#: Every state of every session gets a different number, see
+#: [Session.state_changed].
+_state_ids = itertools.count(1)
+
+class Session (object):
+    """
+    Everything Coquille knows about one buffer: its coqtop, what has been
+    checked, what is waiting to be, ...
+
+    A session outlives its coqtop: when its process is evicted from the
+    [SessionPool], the session is just [reset] and a new coqtop is started the
+    next time it is needed.
+    """
+
+    def __init__(self, bufnr, args):
+        self.bufnr = bufnr
+        #: The extra arguments coqtop is launched with.
+        self.args = args
+        #: See [CoqTop]
+        self.coqtop = None
+        #: See [CheckpointCache]
+        self.checkpoints = None
+        #: See vimbufsync ( https://github.com/def-lkb/vimbufsync )
+        self.saved_sync = None
+        #: The changedtick of the buffer when [saved_sync] was taken.
+        self.synced_tick = None
+        #: Sentence ends of the buffer, see [SentenceIndex].
+        self.sentences = SentenceIndex()
+        #: Where its lines start, see [LineOffsets].
+        self.offsets = LineOffsets()
+        #: The messages shown in the Infos panel when this buffer is the
+        #: current one.
+        self.info = MessageLog()
+        #: See [make_highlighter], created the first time the buffer is
+        #: highlighted.
+        self.highlighter = None
+        self.reset()
+
+    def reset(self):
+        """ Forgets about everything coqtop checked. """
+        #: Keeps track of what have been checked by Coq, and what is waiting to
+        #: be checked.
+        self.encountered_dots = StateIndex()
+        self.send_queue = deque([])
+        #: The commands sent to coqtop whose answer hasn't been processed yet,
+        #: as (command, future) pairs. They are the first elements of
+        #: [send_queue].
+        self.in_flight = deque([])
+        #: Move the cursor once the current asynchronous [send_until_fail] is
+        #: over.
+        self.move_when_done = False
+        #: The batch stopped on an error, and the commands sent after it were
+        #: given up on: [poll] finishes it once coqtop answered them.
+        self.settling = False
+        self.error_at = None
+        #: Goals of the states we went through, indexed by their number of
+        #: encountered dots. No proof is open before the first sentence.
+        self.goal_cache = OrderedDict([(0, None)])
+        #: How many of the last states of [encountered_dots] were reached
+        #: speculatively, i.e. without the user asking for it yet (see
+        #: [g:coquille_prefetch]).
+        self.speculative = 0
+        #: The messages of the speculative states, and the goal calls made
+        #: for them, indexed by state.
+        self.prefetched_messages = {}
+        self.prefetched_goals = {}
+        #: Where the last failing sentence ends: it isn't worth checking it
+        #: again speculatively.
+        self.prefetch_error = None
+        self.saved_sync = None
+        self.synced_tick = None
+        self.sentences.invalidate()
+        self.offsets.invalidate()
+        self.state_changed()
+
+    def committed(self):
+        """ The number of states the user asked for. """
+        return len(self.encountered_dots) - self.speculative
+
+    def state_changed(self):
+        #: Changes every time coqtop's state changes.
+        self.state_id = next(_state_ids)
+
+    def stop(self):
+        """ Closes coqtop, the session starts from scratch next time. """
+        if self.coqtop is not None:
+            self.coqtop.close()
+            self.coqtop = None
+        if self.checkpoints is not None:
+            self.checkpoints.save()
+        self.reset()
+
+class SessionPool (object):
+    """
+    The sessions of every buffer, the most recently used last.
+
+    At most [max_running] of them have a coqtop running: starting one more
+    stops the coqtop of the least recently used session (see [make_room]).
+    """
+
+    def __init__(self, max_running=4):
+        self.max_running = max_running
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    def get(self, bufnr):
+        """ Returns the session of buffer [bufnr] (or None), and marks it used. """
+        session = self._sessions.pop(bufnr, None)
+        if session is not None:
+            self._sessions[bufnr] = session
+        return session
+
+    def add(self, session):
+        self.remove(session.bufnr)
+        self._sessions[session.bufnr] = session
+
+    def remove(self, bufnr):
+        session = self._sessions.pop(bufnr, None)
+        if session is not None:
+            session.stop()
+
+    def make_room(self, session):
+        """
+        Stops the coqtops of the least recently used sessions, so that
+        [session] can start its own. Busy sessions are spared if possible.
+        Returns the sessions which were stopped.
+        """
+        running = [s for s in self._sessions.values()
+                   if s.coqtop is not None and s is not session]
+        excess = len(running) + 1 - max(1, self.max_running)
+        if excess <= 0:
+            return []
+        idle = [s for s in running if not s.in_flight]
+        busy = [s for s in running if s.in_flight]
+        stopped = (idle + busy)[:excess]
+        for s in stopped:
+            s.stop()
+        return stopped
@@ -0,0 +1,54 @@
+from collections import deque
+
+#: The budgets of the kinds of call the user gave none for, when vim is
+#: blocked waiting for coqtop: nothing else can interrupt it then (coqtop
+#: runs in its own process group, so ^C doesn't reach it).
+BLOCKING_BUDGETS = {
+    'interp': 60.0,
+    'goal':   10.0,
+    'rewind': 10.0,
+}
+
+class TimeoutPolicy (object):
+    """
+    Decides how long to wait for the answer to a call made to coqtop.
+
+    Silence alone doesn't mean coqtop died: a sentence can legitimately take
+    hours. Only the death of the process, checked every [poll_interval]
+    seconds, makes us give up on a call; interrupting a computation is up to
+    the user (see [CoqTop.interrupt]).
+    Unless [budgets] gives, by kind of call, how long (in seconds) coqtop may
+    stay silent on it. That budget grows with the latencies observed for that
+    kind of call, so that calls which are slow but no slower than usual are
+    never mistaken for a crash. When the budget is exhausted coqtop is
+    interrupted (which makes the call fail cleanly), and only if it doesn't
+    answer within [grace] seconds after that do we give up on it.
+    """
+
+    def __init__(self, budgets=None, history=50, slack=4.0,
+                 poll_interval=0.5, grace=5.0):
+        self.budgets = dict(budgets or {})
+        self.slack = slack
+        self.poll_interval = poll_interval
+        self.grace = grace
+        self._history = history
+        self.latencies = {}
+
+    def record(self, kind, seconds):
+        """ Remembers that coqtop took [seconds] to answer a call of [kind]. """
+        if kind not in self.latencies:
+            self.latencies[kind] = deque([], self._history)
+        self.latencies[kind].append(seconds)
+
+    def budget(self, kind):
+        """
+        How long coqtop may stay silent on a call of [kind], None if it has
+        all the time it needs.
+        """
+        base = self.budgets.get(kind)
+        if base is None:
+            return None
+        observed = self.latencies.get(kind)
+        if not observed:
+            return base
+        return max(base, self.slack * max(observed))
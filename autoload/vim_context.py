@@ -0,0 +1,179 @@
+import vim
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+#: What every command may need to know about vim, read all at once by
+#: [Context.option].
+OPTIONS = [
+    ('bufnr',           "bufnr('%')"),
+    ('cursor',          "[line('.'), col('.') - 1]"),
+    ('encoding',        "&encoding"),
+    ('fileencoding',    "&fileencoding"),
+    ('timers',          "has('timers')"),
+    ('textprop',        "exists('*prop_add')"),
+    ('auto_move',       "g:coquille_auto_move"),
+    ('coqtop_path',     "g:coquille_coqtop_path"),
+    ('pipeline_depth',  "g:coquille_pipeline_depth"),
+    ('timeouts',        "g:coquille_timeouts"),
+    ('async',           "g:coquille_async"),
+    ('cache_dir',       "g:coquille_cache_dir"),
+    ('max_sessions',    "g:coquille_max_sessions"),
+    ('prefetch',        "g:coquille_prefetch"),
+    ('message_levels',  "g:coquille_message_levels"),
+    ('info_size',       "g:coquille_info_size"),
+    ('trace_file',      "g:coquille_trace_file"),
+    ('build_deps',      "g:coquille_build_deps"),
+]
+
+_OPTIONS_EXPR = '[%s]' % ', '.join(expr for (_, expr) in OPTIONS)
+
+class Context (object):
+    """
+    Everything a command exchanges with vim.
+
+    Each call into vim has a cost, so a command asks for the options (and
+    for the lines of a buffer) once, and gets a snapshot of them; and its
+    effects on vim (highlighting, cursor moves, redraws, ...) are queued, to
+    be applied all at once by [flush] when the command is over.
+    [crossings] counts the calls into vim.
+    """
+
+    def __init__(self, tracer=None):
+        #: See [CallTrace], records the redraws.
+        self.tracer = tracer
+        self.crossings = 0
+        self._options = None
+        self._evals = {}
+        self._lines = {}
+        self._commands = []
+        self._deferred = OrderedDict()
+        self._redraw = False
+
+    def option(self, name):
+        """ The value of the option [name] of [OPTIONS]. """
+        if self._options is None:
+            values = self.eval(_OPTIONS_EXPR)
+            self._options = dict((name, value) for ((name, _), value)
+                                 in zip(OPTIONS, values))
+        return self._options[name]
+
+    def eval(self, expr):
+        """ Evaluates [expr], once per command. """
+        if expr not in self._evals:
+            self.crossings += 1
+            self._evals[expr] = vim.eval(expr)
+        return self._evals[expr]
+
+    def lines(self, bufnr):
+        """ A copy of the lines of buffer [bufnr]. """
+        if bufnr not in self._lines:
+            self.crossings += 1
+            self._lines[bufnr] = vim.buffers[bufnr][:]
+        return self._lines[bufnr]
+
+    def buffer(self, bufnr):
+        """ The buffer [bufnr] itself, to write to it. """
+        self.crossings += 1
+        self._lines.pop(bufnr, None)
+        return vim.buffers[bufnr]
+
+    def command(self, cmd):
+        """ Queues the ex command [cmd]. """
+        self._commands.append(cmd)
+
+    def defer(self, key, action):
+        """
+        Calls [action] (which queues commands) just before the [flush],
+        unless another action is deferred with the same [key] in the
+        meantime: only the last one is called.
+        """
+        self._deferred.pop(key, None)
+        self._deferred[key] = action
+
+    def command_now(self, cmd):
+        """ Runs [cmd] right away, after what was queued. """
+        self.command(cmd)
+        self.flush()
+        # It can do anything.
+        self._options = None
+        self._evals = {}
+        self._lines = {}
+
+    def set_cursor(self, line, col):
+        """ Moves the cursor to [line] (from 1) and [col] (from 0). """
+        self.command('call cursor(%d, %d)' % (line, col + 1))
+        if self._options is not None:
+            self._options['cursor'] = [str(line), str(col)]
+
+    def redraw(self):
+        self._redraw = True
+
+    def flush(self):
+        """ Applies what was queued, in a single call. """
+        while self._deferred:
+            (_, action) = self._deferred.popitem(last=False)
+            action()
+        (commands, self._commands) = (self._commands, [])
+        redraw = self._redraw
+        self._redraw = False
+        if redraw:
+            commands.append('redraw')
+        if not commands:
+            return
+        start = time.time()
+        self.crossings += 1
+        vim.command(' | '.join(commands))
+        if redraw and self.tracer is not None:
+            self.tracer.span('redraw', time.time() - start)
+
+class Contexts (object):
+    """
+    Gives the [Context] of the command being run: commands can call each
+    other, only the outermost one gets a new context and flushes it.
+    """
+
+    def __init__(self, tracer=None):
+        self.tracer = tracer
+        self._current = None
+        self._depth = 0
+
+    def current(self):
+        """
+        The context of the current command. Outside of a [command], what is
+        queued is applied right away.
+        """
+        if self._depth == 0:
+            return _Immediate(self.tracer)
+        return self._current
+
+    @contextmanager
+    def command(self, name):
+        if self._depth == 0:
+            self._current = Context(self.tracer)
+        self._depth += 1
+        try:
+            yield self._current
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                context = self._current
+                self._current = None
+                context.flush()
+                if self.tracer is not None and context.crossings:
+                    self.tracer.count('crossings', name, context.crossings)
+
+class _Immediate (Context):
+    """ A [Context] which doesn't wait for the end of a command. """
+    def command(self, cmd):
+        Context.command(self, cmd)
+        self.flush()
+
+    def defer(self, key, action):
+        action()
+        self.flush()
+
+    def redraw(self):
+        Context.redraw(self)
+        self.flush()
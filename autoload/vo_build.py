@@ -0,0 +1,343 @@
+import os
+import re
+import json
+import time
+import hashlib
+import tempfile
+import subprocess
+import multiprocessing
+
+from json_file import read_json, write_json
+from sentence_index import LineOffsets, SentenceIndex, normalize
+
+_REQUIRE = re.compile(r'(?:From\s+(\S+)\s+)?Require\s+(?:(?:Import|Export)\s+)?'
+                      r'(.*)\.$', re.S)
+
+def required_modules(lines):
+    """
+    The modules the Require sentences of [lines] (unicode strings) load, as
+    (prefix given by "From", or None; name) pairs.
+    """
+    sentences = SentenceIndex()
+    offsets = LineOffsets()
+    modules = []
+    pos = (0, 0)
+    while True:
+        stop = sentences.next_chunk(lines, pos[0], pos[1])
+        if stop is None:
+            return modules
+        m = _REQUIRE.match(normalize(offsets.text(lines, pos, stop)))
+        if m is not None:
+            modules.extend((m.group(1), name) for name in m.group(2).split())
+        pos = (stop[0], stop[1] + 1)
+
+def read_lines(path):
+    with open(path, 'rb') as f:
+        return f.read().decode('utf-8', 'replace').split('\n')
+
+class LoadPath (object):
+    """
+    The .v files coqtop can load given its -R, -Q and -I arguments, by
+    logical name.
+
+    Like coqtop, a module can be required by a suffix of its name if its
+    directory was given with -R or -I, but only by its full name with -Q.
+    The modules which aren't found (e.g. the ones of the standard library)
+    aren't ours to build.
+    """
+
+    def __init__(self, args):
+        #: The .v file of every logical name.
+        self.files = {}
+        #: The logical names which can be shortened, by their last part.
+        self._by_last = {}
+        args = list(args)
+        idx = 0
+        while idx < len(args):
+            arg = args[idx]
+            if arg in ('-R', '-Q') and idx + 2 < len(args):
+                self._add(args[idx + 1], args[idx + 2], True, arg == '-R')
+                idx += 3
+            elif arg == '-I' and idx + 1 < len(args):
+                (directory, prefix) = (args[idx + 1], '')
+                idx += 2
+                if args[idx:idx + 1] == ['-as'] and idx + 1 < len(args):
+                    prefix = args[idx + 1]
+                    idx += 2
+                self._add(directory, prefix, False, True)
+            else:
+                idx += 1
+
+    def resolve(self, prefix, name):
+        """ The .v file of the module [name] (required from [prefix]). """
+        full = '%s.%s' % (prefix, name) if prefix else name
+        if full in self.files:
+            return self.files[full]
+        for logical in sorted(self._by_last.get(full.split('.')[-1], ())):
+            if logical.endswith('.' + full) and \
+                    (prefix is None or logical.startswith(prefix + '.')):
+                return self.files[logical]
+        return None
+
+    def _add(self, directory, prefix, recursive, shortened):
+        directory = os.path.abspath(os.path.expanduser(directory))
+        for (root, dirs, files) in os.walk(directory):
+            relative = os.path.relpath(root, directory)
+            parts = [prefix] if prefix else []
+            if relative != os.curdir:
+                parts.extend(relative.split(os.sep))
+            for name in files:
+                if not name.endswith('.v'):
+                    continue
+                logical = '.'.join(parts + [name[:-2]])
+                self.files.setdefault(logical, os.path.join(root, name))
+                if shortened:
+                    self._by_last.setdefault(name[:-2], set()).add(logical)
+            if not recursive:
+                break
+
+class BuildCache (object):
+    """
+    The digest (see [VoBuilder]) of every .v file when it was last compiled,
+    kept in the JSON file [path] if given, otherwise in memory only.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._digests = None
+        self._dirty = False
+
+    def get(self, source):
+        return self._load().get(source)
+
+    def set(self, source, digest):
+        self._load()[source] = digest
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty or self.path is None:
+            return
+        if write_json(self.path, self._digests):
+            self._dirty = False
+
+    def _load(self):
+        if self._digests is not None:
+            return self._digests
+        self._digests = {}
+        if self.path is not None:
+            self._digests = read_json(self.path, self._digests)
+        return self._digests
+
+class VoBuilder (object):
+    """
+    Compiles, with [coqc_path], the libraries a buffer requires (and the ones
+    they require, ...) whose .vo is missing or out of date, [jobs] at once,
+    each one as soon as its own dependencies are compiled.
+
+    A library is out of date when its digest changed since it was last
+    compiled: the digest covers its source, the coqc command line and the
+    digests of its dependencies, so an edit anywhere below it is noticed but
+    touching a file isn't. A .vo compiled by someone else is trusted when it
+    is newer than its source and than the ones it depends on. Whatever its
+    digest, a .vo which is missing, or older than the ones it depends on, is
+    compiled again.
+    """
+
+    def __init__(self, coqc_path, args, cache=None, jobs=None):
+        self.coqc_path = coqc_path
+        self.args = list(args)
+        self.load_path = LoadPath(self.args)
+        self.cache = cache or BuildCache()
+        self.jobs = jobs or multiprocessing.cpu_count()
+
+    def dependencies(self, lines, exclude=None):
+        """
+        The graph of the libraries [lines] require, as a dict giving the .v
+        files every .v file requires. [exclude] (the file being edited)
+        isn't part of it.
+        """
+        graph = {}
+        roots = self._requires(lines, exclude)
+        todo = list(roots)
+        while todo:
+            source = todo.pop()
+            if source in graph:
+                continue
+            try:
+                graph[source] = self._requires(read_lines(source), exclude,
+                                               source)
+            except (IOError, OSError):
+                graph[source] = []
+            todo.extend(graph[source])
+        return graph
+
+    def build(self, lines, exclude=None):
+        """
+        Compiles what [lines] need. Returns the .v files compiled, and the
+        ones which couldn't be, as (path, output of coqc) pairs.
+        """
+        graph = self.dependencies(lines, exclude)
+        (order, cyclic) = _topological_order(graph)
+        stale = self._stale(graph, order)
+        failed = [(source, "Require cycle") for source in cyclic]
+        built = []
+
+        waiting = [source for source in order if source in stale]
+        running = {}
+        broken = set(cyclic)
+        while waiting or running:
+            for source in list(waiting):
+                if len(running) >= self.jobs:
+                    break
+                deps = graph[source]
+                if any(dep in broken for dep in deps):
+                    waiting.remove(source)
+                    broken.add(source)
+                    failed.append((source, "a dependency failed"))
+                elif not any(dep in running or dep in waiting
+                             for dep in deps):
+                    waiting.remove(source)
+                    running[source] = self._compile(source)
+            if not running:
+                continue
+            time.sleep(0.01)
+            for source in list(running):
+                (proc, output) = running[source]
+                if proc.poll() is None:
+                    continue
+                del running[source]
+                output.seek(0)
+                if proc.returncode == 0:
+                    built.append(source)
+                    self.cache.set(source, stale[source])
+                else:
+                    broken.add(source)
+                    failed.append((source, output.read().decode('utf-8',
+                                                                'replace')))
+                output.close()
+        self.cache.save()
+        return (built, failed)
+
+    def _requires(self, lines, exclude, source=None):
+        found = []
+        for (prefix, name) in required_modules(lines):
+            path = self.load_path.resolve(prefix, name)
+            if path is not None and path not in (exclude, source) and \
+                    path not in found:
+                found.append(path)
+        return found
+
+    def _stale(self, graph, order):
+        """
+        The digest of every file of [graph] which has to be compiled, by
+        file. [order] lists the dependencies of a file before it.
+        """
+        command_line = json.dumps([self.coqc_path] + self.args)
+        digests = {}
+        stale = {}
+        for source in order:
+            deps = graph[source]
+            h = hashlib.sha1(command_line.encode('utf-8'))
+            try:
+                with open(source, 'rb') as f:
+                    h.update(f.read())
+            except (IOError, OSError):
+                continue
+            for dep in deps:
+                h.update(digests.get(dep, '').encode('ascii'))
+            digest = digests[source] = h.hexdigest()
+            if any(dep in stale for dep in deps):
+                stale[source] = digest
+                continue
+            known = self.cache.get(source)
+            # The .vo can be removed, or its dependencies compiled again,
+            # behind our back.
+            present = _newer(source + 'o', [dep + 'o' for dep in deps])
+            if known == digest and present:
+                continue
+            if known is None and present and _newer(source + 'o', [source]):
+                self.cache.set(source, digest)
+                continue
+            stale[source] = digest
+        return stale
+
+    def _compile(self, source):
+        output = tempfile.TemporaryFile()
+        proc = subprocess.Popen([self.coqc_path] + self.args + [source],
+                                stdout=output, stderr=subprocess.STDOUT)
+        return (proc, output)
+
+def _newer(target, sources):
+    """ Whether [target] exists, and is newer than every file of [sources]. """
+    try:
+        mtime = os.path.getmtime(target)
+        return all(os.path.getmtime(source) <= mtime for source in sources)
+    except OSError:
+        return False
+
+def _topological_order(graph):
+    """
+    The files of [graph], every one after the ones it depends on, and the
+    ones which depend on themselves (maybe indirectly).
+    """
+    order = []
+    state = {}  # 1: being visited, 2: done
+    cyclic = set()
+    for root in sorted(graph):
+        stack = [(root, iter(graph[root]))]
+        if root in state:
+            continue
+        state[root] = 1
+        while stack:
+            (node, deps) = stack[-1]
+            dep = next(deps, None)
+            if dep is None:
+                stack.pop()
+                state[node] = 2
+                order.append(node)
+            elif state.get(dep) == 1:
+                cyclic.update(n for (n, _) in stack)
+            elif dep not in state and dep in graph:
+                state[dep] = 1
+                stack.append((dep, iter(graph[dep])))
+    return ([node for node in order if node not in cyclic], sorted(cyclic))
+
+if __name__ == '__main__':
+    # Self-check, with a fake coqc which only writes the .vo.
+    import shutil
+    import sys
+    directory = tempfile.mkdtemp()
+    try:
+        coqc = os.path.join(directory, 'coqc.py')
+        with open(coqc, 'w') as f:
+            f.write("import sys\nopen(sys.argv[-1] + 'o', 'w').close()\n")
+        os.mkdir(os.path.join(directory, 'src'))
+        for (name, text) in [('A', 'Definition a := 1.\n'),
+                             ('B', 'Require Import A.\n')]:
+            with open(os.path.join(directory, 'src', name + '.v'), 'w') as f:
+                f.write(text)
+        args = ['-R', os.path.join(directory, 'src'), 'Src']
+        cache_path = os.path.join(directory, 'builds.json')
+        lines = [u'Require Import B.']
+        def build():
+            # The cache is read again from its file every time.
+            builder = VoBuilder(sys.executable, [coqc] + args,
+                                BuildCache(cache_path))
+            (built, failed) = builder.build(lines)
+            assert not failed, failed
+            return sorted(os.path.basename(source) for source in built)
+        vo = os.path.join(directory, 'src', 'A.vo')
+        assert build() == ['A.v', 'B.v']
+        assert build() == []
+        # A removed .vo is compiled again, even though the digest matches;
+        # and so is what depends on it.
+        os.remove(vo)
+        assert build() == ['A.v', 'B.v'], 'removed .vo'
+        assert os.path.exists(vo)
+        # Touching a source doesn't make it stale.
+        time.sleep(0.01)
+        os.utime(os.path.join(directory, 'src', 'A.v'), None)
+        assert build() == []
+        print("ok")
+    finally:
+        shutil.rmtree(directory)
@@ -25,6 +25,8 @@ def enqueue_xml_one_by_one(out, queue):
     message = ''
     while True:
         acc = out.read(1)
+        if not acc:
+            break
         message += acc
         try:
             xml_message = ET.fromstring(message)
@@ -41,6 +43,9 @@ def enqueue_xml(out, queue):
     while True:
         select.select([out], [], [])
         acc = out.read(1024)
+        if not acc:
+            # End of the stream.
+            break
         for c in acc:
             message += c
             if c != '>':
@@ -55,16 +60,21 @@ def enqueue_xml(out, queue):
 def enqueue_xml_stream(out, queue):
     """Fancyest way, steaming and POSIX only"""
     depth = 0
+    root = None
     s = InfiniteXML(out)
     try:
         for (event, node) in ET.iterparse(s, events=['start', 'end']):
             if event == 'start':
                 depth += 1
+                if root is None:
+                    root = node
             elif event == 'end':
                 depth -= 1
-            # We want the children of <root>
-            if depth == 1:
-                queue.put(node)
+                # We want the children of <root>
+                if depth == 1:
+                    queue.put(node)
+                    # Otherwise <root> keeps every message of the session.
+                    root.remove(node)
     except ET.ParseError:
         # We hit the end of the stream?
         pass
@@ -92,13 +102,20 @@ class InfiniteXML (object):
 
 
 if __name__ == "__main__":
+    # See ../bench/bench_xml.py for the real benchmarks.
+    from os import path
+    fake_coqtop = path.join(path.dirname(path.abspath(__file__)),
+                            path.pardir, 'bench', 'fake_coqtop.py')
     oracle = AsyncPipe(
-        dict(args=["python", "xml_oracle.py"], stderr=sys.stdout),
+        dict(args=[sys.executable, fake_coqtop], stderr=sys.stdout),
         enqueue_xml_stream)
 
 
     for i in range(10):
-        oracle.write(str(i*i)+"\n")
+        oracle.write(b'<call id="1" val="interp">Check ' + str(i*i).encode()
+                     + b'.</call>\n')
+        # Writes are only sent when flushed, see [AsyncPipe.write].
+        oracle.flush()
         print("")
         print(i)
         try:
@@ -107,4 +124,4 @@ if __name__ == "__main__":
             print("No output yet")
             continue
 
-        print("node: " + str(node.text))
+        print("node: " + node.tag + " " + str(node.get('val')))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the cost of sending calls to coqtop: encoding them, and writing
+them on the pipe. The calls go to a process which just reads them.
+
+It compares, per call:
+- the former path (str.format, saxutils.escape, then encoding, and a flush
+  after every call),
+- coq_calls with a flush after every call,
+- coq_calls with the calls of a pipeline written at once (--depth of them,
+  like CoqTop.batch does).
+
+Run it with the python your vim is linked against.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from xml.sax.saxutils import escape
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'autoload'))
+
+import coq_calls
+from async_pipe import AsyncPipe
+
+# Reads everything it gets, and nothing else.
+DRAIN = "import os\nwhile os.read(0, 65536):\n    pass\n"
+
+SENTENCES = [
+    u"intros x y H.",
+    u"rewrite <- H; simpl; auto.",
+    u"Lemma plus_comm : forall n m : nat, n + m = m + n.",
+    u"Check (fun (α : Type) (x : α) => x).",
+    u"destruct (le_lt_dec n m) as [Hle|Hlt]; [left|right]; omega.",
+    u"Notation \"x <= y <= z\" := (x <= y /\\ y <= z) (at level 70, y at next level).",
+]
+
+def former_encode(sentence):
+    # With a unicode template: the former one failed on non-ASCII sentences
+    # under python 2.
+    text = u'<call id="1" val="interp">{}</call>'.format(escape(sentence))
+    return (u"%s\n" % text).encode('utf-8')
+
+def _drain(out, queue):
+    for _ in iter(lambda: out.read(65536), b''):
+        pass
+
+def timed(calls, run):
+    start = time.time()
+    run()
+    return (time.time() - start) / calls * 1e6
+
+def bench_encode(calls):
+    sentences = [SENTENCES[i % len(SENTENCES)] for i in range(calls)]
+    former = timed(calls, lambda: [former_encode(s) for s in sentences])
+    new = timed(calls, lambda: [coq_calls.interp(1, s) for s in sentences])
+    return {'former': former, 'coq_calls': new}
+
+def bench_write(calls, depth):
+    pipe = AsyncPipe(dict(args=[sys.executable, '-c', DRAIN]), _drain)
+    stdin = pipe.proc.stdin
+    sentences = [SENTENCES[i % len(SENTENCES)] for i in range(calls)]
+
+    def former_write(data):
+        # What AsyncPipe.write used to do.
+        stdin.write(data)
+        stdin.flush()
+
+    def former():
+        for sentence in sentences:
+            former_write(former_encode(sentence))
+
+    def unbatched():
+        for sentence in sentences:
+            pipe.send(coq_calls.interp(1, sentence))
+
+    def batched():
+        for (idx, sentence) in enumerate(sentences):
+            pipe.write(coq_calls.interp(1, sentence))
+            if (idx + 1) % depth == 0:
+                pipe.flush()
+        pipe.flush()
+
+    try:
+        return {'former': timed(calls, former),
+                'coq_calls': timed(calls, unbatched),
+                'coq_calls, batched': timed(calls, batched),
+                'writes, batched': (calls + depth - 1) // depth}
+    finally:
+        pipe.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--calls', type=int, default=100000)
+    parser.add_argument('--depth', type=int, default=8,
+                        help="calls written at once when batched")
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    results = {'encode': bench_encode(args.calls),
+               'encode and write': bench_write(args.calls, args.depth)}
+    if args.json:
+        print(json.dumps(results, sort_keys=True))
+        return
+    print('{} calls, batches of {}'.format(args.calls, args.depth))
+    for (name, row) in sorted(results.items()):
+        print(name)
+        for (path, value) in sorted(row.items()):
+            if path.startswith('writes'):
+                print('  {:<22} {:>9d}'.format(path, value))
+            else:
+                print('  {:<22} {:>7.2f}us/call'.format(path, value))
+
+if __name__ == '__main__':
+    main()
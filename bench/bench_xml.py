@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Benchmarks the XML parsers of xml_stream_parser.py, and CoqTop calls end to
+end, against fake_coqtop.py (so no Coq install is needed).
+
+For every parser it reports:
+- the throughput and per-message latency when coqtop floods us with
+  messages (the latency being measured from the moment the fake sent the
+  message to the moment it came out of the queue),
+- the memory allocated while doing so (peak, as seen by tracemalloc when
+  available, otherwise the growth of the maximum resident set size),
+- the latency of CoqTop.interp and CoqTop.goals calls.
+
+Run it with the python your vim is linked against.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'autoload'))
+FAKE_COQTOP = os.path.join(HERE, 'fake_coqtop.py')
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty  # python 3.x
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+import resource
+
+import xml_stream_parser
+from async_pipe import AsyncPipe
+from coqtop import CoqTop
+from timeout_policy import TimeoutPolicy
+
+PARSERS = ['enqueue_xml_one_by_one', 'enqueue_xml', 'enqueue_xml_stream']
+
+#: The parsers which build their messages out of str, so only work on
+#: python 2: on python 3 they kill the reader thread on the first byte.
+PYTHON2_ONLY = ['enqueue_xml_one_by_one', 'enqueue_xml']
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+class MemoryProbe (object):
+    """ Peak memory allocated (in KB) between [start] and [stop]. """
+    def start(self):
+        if tracemalloc:
+            tracemalloc.start()
+        self._rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def stop(self):
+        if tracemalloc:
+            (_, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return peak // 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - self._rss
+
+def bench_stream(parser_name, nb_messages, size, rate, timeout):
+    """ Parses [nb_messages] messages flooded by the fake coqtop. """
+    parser = getattr(xml_stream_parser, parser_name)
+    memory = MemoryProbe()
+    memory.start()
+    pipe = AsyncPipe(
+        dict(args=[sys.executable, FAKE_COQTOP, '--flood', str(nb_messages),
+                   '--size', str(size), '--rate', str(rate)]),
+        parser)
+    latencies = []
+    first_sent = None
+    last_received = None
+    correct = True
+    deadline = time.time() + timeout
+    try:
+        for _ in range(nb_messages):
+            node = pipe.get(True, max(0.0, deadline - time.time()))
+            last_received = time.time()
+            try:
+                (sent, payload) = node.find('string').text.split(' ', 1)
+                sent = float(sent)
+                correct = correct and len(payload) == size
+            except (AttributeError, ValueError):
+                correct = False
+                continue
+            if first_sent is None:
+                first_sent = sent
+            latencies.append(last_received - sent)
+    except Empty:
+        correct = False
+    finally:
+        pipe.close()
+    peak = memory.stop()
+
+    result = {'parser': parser_name, 'messages': len(latencies),
+              'correct': correct and len(latencies) == nb_messages,
+              'peak_kb': peak}
+    if latencies:
+        elapsed = max(last_received - first_sent, 1e-9)
+        result.update({
+            'msgs_per_s': len(latencies) / elapsed,
+            'mb_per_s': len(latencies) * size / elapsed / 1e6,
+            'latency_ms_p50': percentile(latencies, 50) * 1000,
+            'latency_ms_p95': percentile(latencies, 95) * 1000,
+            'latency_ms_max': max(latencies) * 1000,
+        })
+    return result
+
+def bench_calls(parser_name, nb_calls, goal_size, hyp_length, timeout):
+    """
+    Times CoqTop.interp and CoqTop.goals against the fake coqtop, which may
+    stay silent [timeout] seconds on a call.
+    """
+    parser = getattr(xml_stream_parser, parser_name)
+    logfile = open(os.devnull, 'w')
+    result = {'parser': parser_name}
+    budgets = dict((kind, timeout) for kind in ('interp', 'goal', 'rewind'))
+    coqtop = CoqTop(FAKE_COQTOP, ['--goal-size', str(goal_size),
+                                  '--hyp-length', str(hyp_length)],
+                    logfile, xml_parser=parser,
+                    timeouts=TimeoutPolicy(budgets, grace=timeout))
+    try:
+        # Don't count the startup of the fake coqtop.
+        coqtop.interp('Check nat.')
+        for (kind, call) in [('interp', lambda: coqtop.interp('Check nat.')),
+                             ('goal', coqtop.goals)]:
+            latencies = []
+            for _ in range(nb_calls):
+                start = time.time()
+                (_, response) = call()
+                latencies.append(time.time() - start)
+                if response is None:
+                    raise RuntimeError('no answer to a {} call'.format(kind))
+            result.update({
+                kind + '_ms_p50': percentile(latencies, 50) * 1000,
+                kind + '_ms_p95': percentile(latencies, 95) * 1000,
+            })
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        coqtop.close()
+        logfile.close()
+    return result
+
+def show(results, columns):
+    print('  '.join('{:>22}'.format(c) for c in columns))
+    for r in results:
+        cells = []
+        for c in columns:
+            v = r.get(c, '-')
+            cells.append('{:>22.3f}'.format(v) if isinstance(v, float)
+                         else '{:>22}'.format(v))
+        print('  '.join(cells))
+        if 'error' in r:
+            print('    ' + r['error'])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--parsers', default=','.join(PARSERS))
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=1000,
+                        help="size of each message, in bytes")
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help="messages per second (0: no limit)")
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--goal-size', type=int, default=50)
+    parser.add_argument('--hyp-length', type=int, default=80)
+    parser.add_argument('--timeout', type=float, default=20.0,
+                        help="seconds given to each parser, and to each call")
+    parser.add_argument('--json', action='store_true',
+                        help="print the results as JSON lines")
+    args = parser.parse_args()
+
+    stream = []
+    calls = []
+    for name in args.parsers.split(','):
+        if name in PYTHON2_ONLY and sys.version_info[0] >= 3:
+            sys.stderr.write('Skipping {}: it only runs on python 2\n'
+                             .format(name))
+            continue
+        stream.append(bench_stream(name, args.messages, args.size, args.rate,
+                                   args.timeout))
+        calls.append(bench_calls(name, args.calls, args.goal_size,
+                                 args.hyp_length, args.timeout))
+
+    if args.json:
+        for r in stream:
+            print(json.dumps(dict(r, bench='stream')))
+        for r in calls:
+            print(json.dumps(dict(r, bench='calls')))
+        return
+
+    print('Streaming {} messages of {} bytes:'.format(args.messages, args.size))
+    show(stream, ['parser', 'correct', 'msgs_per_s', 'mb_per_s',
+                  'latency_ms_p50', 'latency_ms_p95', 'peak_kb'])
+    print('')
+    print('{} calls, goals of {} hypotheses:'.format(args.calls, args.goal_size))
+    show(calls, ['parser', 'interp_ms_p50', 'interp_ms_p95', 'goal_ms_p50',
+                 'goal_ms_p95'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+A stand-in for `coqtop -ideslave`, to benchmark coquille without Coq.
+
+It reads calls on stdin and answers them on stdout, like coqtop would:
+
+- by default answers are generated: every interp succeeds (unless the
+  sentence contains "fail"), goals are made of --goal-size hypotheses of
+  --hyp-length characters, rewinds never need additional steps;
+- with --transcript, the answers recorded in a file are replayed in order,
+  whatever the calls are;
+- with --flood, it doesn't wait for calls: it sends that many messages (each
+  one starting with the time it was sent at) and exits.
+
+SIGINT interrupts the current call, which then fails as with coqtop. A quit
+call (or the end of stdin) makes it exit.
+"""
+import argparse
+import signal
+import sys
+import time
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+if hasattr(sys.stdout, 'buffer'):
+    stdout = sys.stdout.buffer
+    stdin = sys.stdin.buffer
+else:
+    stdout = sys.stdout
+    stdin = sys.stdin
+
+def out(text):
+    stdout.write(text.encode('utf-8'))
+    stdout.flush()
+
+def message(text, level='info'):
+    return ('<message><message_level val="{}"/><string>{}</string></message>'
+            .format(level, escape(text)))
+
+def good(payload='<string></string>'):
+    return '<value val="good">{}</value>'.format(payload)
+
+def fail(text, loc_s=None, loc_e=None):
+    """ Like coqtop, no location unless the sentence is at fault. """
+    if loc_s is None:
+        return '<value val="fail">{}</value>'.format(escape(text))
+    return ('<value val="fail" loc_s="{}" loc_e="{}">{}</value>'
+            .format(loc_s, loc_e, escape(text)))
+
+def goals(size, length):
+    if size < 0:
+        return good('<option val="none"/>')
+    hyps = ''.join('<string>H{} : {}</string>'.format(i, 'x' * length)
+                   for i in range(size))
+    return good('<option val="some"><goals><list><goal><string>1</string>'
+                '<list>{}</list><string>True</string></goal></list><list/>'
+                '</goals></option>'.format(hyps))
+
+def read_transcript(path):
+    """ Splits a recorded transcript into answers (messages + value). """
+    with open(path, 'rb') as f:
+        root = ET.fromstring(b'<transcript>' + f.read() + b'</transcript>')
+    answers = []
+    current = ''
+    for elt in root:
+        current += ET.tostring(elt).decode('utf-8')
+        if elt.tag == 'value':
+            answers.append(current)
+            current = ''
+    return answers
+
+def read_calls():
+    """ Yields the calls sent on stdin, as (kind, text, element). """
+    pending = b''
+    for line in iter(stdin.readline, b''):
+        pending += line
+        while True:
+            end = pending.find(b'</call>')
+            if end == -1:
+                break
+            end += len(b'</call>')
+            call = ET.fromstring(pending[pending.find(b'<call'):end])
+            pending = pending[end:]
+            yield (call.get('val'), call.text or '', call)
+
+class Interrupted (Exception):
+    pass
+
+# Only calls are interrupted, like coqtop an idle fake ignores SIGINT.
+working = [False]
+
+def on_sigint(signum, frame):
+    if working[0]:
+        raise Interrupted()
+
+def interruptible_sleep(seconds):
+    """ Returns False if interrupted. """
+    working[0] = True
+    try:
+        time.sleep(seconds)
+        return True
+    except Interrupted:
+        return False
+    finally:
+        working[0] = False
+
+def flood(nb_messages, size, rate):
+    payload = 'y' * size
+    for _ in range(nb_messages):
+        out(message('{!r} {}'.format(time.time(), payload)))
+        if rate:
+            time.sleep(1.0 / rate)
+
+def serve(args):
+    answers = read_transcript(args.transcript) if args.transcript else None
+    for (kind, text, call) in read_calls():
+        if not interruptible_sleep(args.delay):
+            out(fail('User interrupt.'))
+            continue
+        if answers is not None:
+            out(answers.pop(0) if answers else fail('End of transcript.'))
+        elif kind == 'interp':
+            if 'slow' in text and not interruptible_sleep(args.slow):
+                out(fail('User interrupt.'))
+            elif 'fail' in text:
+                out(fail('Error: {}'.format(text.strip()), 0, len(text)))
+            else:
+                out(''.join(message(text.strip())
+                            for _ in range(args.messages)) + good())
+        elif kind == 'goal':
+            out(goals(args.goal_size, args.hyp_length))
+        elif kind == 'rewind':
+            out(good('<int>0</int>'))
+        elif kind == 'quit':
+            out(good())
+            return
+        else:
+            out(fail('Unknown call: {}'.format(kind)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--transcript', help="answers to replay")
+    parser.add_argument('--goal-size', type=int, default=5,
+                        help="number of hypotheses (-1: no proof open)")
+    parser.add_argument('--hyp-length', type=int, default=40)
+    parser.add_argument('--messages', type=int, default=0,
+                        help="messages sent along with each interp answer")
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help="seconds spent on each call")
+    parser.add_argument('--slow', type=float, default=2.0,
+                        help="seconds spent on sentences containing 'slow'")
+    parser.add_argument('--flood', type=int, default=0, metavar='N',
+                        help="send N messages and exit")
+    parser.add_argument('--size', type=int, default=100,
+                        help="size of the flooded messages")
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help="flooded messages per second (0: no limit)")
+    # coquille launches coqtop with "-ideslave -debug" and the user's args.
+    (args, _) = parser.parse_known_args()
+
+    signal.signal(signal.SIGINT, on_sigint)
+    if args.flood:
+        flood(args.flood, args.size, args.rate)
+    else:
+        serve(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Soak test of an XML parser of xml_stream_parser.py: the fake coqtop sends
+messages for a long time and the resident memory of the reading process is
+sampled along the way. It should stay flat once the parser is warmed up.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'autoload'))
+FAKE_COQTOP = os.path.join(HERE, 'fake_coqtop.py')
+
+import resource
+
+import xml_stream_parser
+from async_pipe import AsyncPipe
+
+def resident_kb():
+    """ Current resident set size (Linux), or the maximum one elsewhere. """
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def soak(parser_name, nb_messages, size, nb_samples, timeout):
+    parser = getattr(xml_stream_parser, parser_name)
+    pipe = AsyncPipe(
+        dict(args=[sys.executable, FAKE_COQTOP, '--flood', str(nb_messages),
+                   '--size', str(size)]),
+        parser)
+    every = max(1, nb_messages // nb_samples)
+    samples = []
+    deadline = time.time() + timeout
+    try:
+        for idx in range(nb_messages):
+            node = pipe.get(True, max(0.0, deadline - time.time()))
+            del node
+            if (idx + 1) % every == 0:
+                samples.append((idx + 1, resident_kb()))
+    finally:
+        pipe.close()
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--parser', default='enqueue_xml_stream')
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--size', type=int, default=2000,
+                        help="size of each message, in bytes")
+    parser.add_argument('--samples', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=600.0)
+    parser.add_argument('--json', action='store_true',
+                        help="print the samples as JSON lines")
+    args = parser.parse_args()
+
+    samples = soak(args.parser, args.messages, args.size, args.samples,
+                   args.timeout)
+    if args.json:
+        for (messages, rss) in samples:
+            print(json.dumps({'parser': args.parser, 'messages': messages,
+                              'rss_kb': rss}))
+        return
+
+    print('{}: {} messages of {} bytes'.format(args.parser, args.messages,
+                                               args.size))
+    for (messages, rss) in samples:
+        print('{:>12} messages  {:>10} KB'.format(messages, rss))
+    # Compare the end of the run with its first half, once warmed up.
+    warm = samples[len(samples) // 2][1]
+    print('growth over the second half: {} KB'.format(samples[-1][1] - warm))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Stress test of the lifecycle of CoqTop: launches and closes the fake coqtop
+many times in a row, and checks that no file descriptor, reader thread or
+zombie process is left behind by a close.
+
+Run it with the python your vim is linked against (on Linux: the counts come
+from /proc).
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'autoload'))
+FAKE_COQTOP = os.path.join(HERE, 'fake_coqtop.py')
+
+from coqtop import CoqTop
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+def zombies():
+    """ The children of this process which exited but weren't waited for. """
+    count = 0
+    me = str(os.getpid())
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid) as stat:
+                # The name can contain spaces, but is between parentheses.
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError):
+            continue
+        if fields[1] == me and fields[0] == 'Z':
+            count += 1
+    return count
+
+def sample(cycle):
+    return {'cycle': cycle, 'fds': open_fds(),
+            'threads': threading.active_count(), 'zombies': zombies()}
+
+def stress(cycles, nb_samples):
+    logfile = open(os.devnull, 'w')
+    every = max(1, cycles // nb_samples)
+    samples = [sample(0)]
+    start = time.time()
+    for cycle in range(1, cycles + 1):
+        coqtop = CoqTop(sys.executable, [FAKE_COQTOP], logfile)
+        coqtop.close()
+        if cycle % every == 0:
+            samples.append(sample(cycle))
+    return (samples, time.time() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--cycles', type=int, default=1000)
+    parser.add_argument('--samples', type=int, default=10)
+    parser.add_argument('--json', action='store_true',
+                        help="print the samples as JSON lines")
+    args = parser.parse_args()
+
+    (samples, elapsed) = stress(args.cycles, args.samples)
+    if args.json:
+        for s in samples:
+            print(json.dumps(s))
+    else:
+        print('{} launch/close cycles in {:.1f}s'.format(args.cycles, elapsed))
+        for s in samples:
+            print('{cycle:>8} cycles  {fds:>5} fds  {threads:>4} threads  '
+                  '{zombies:>4} zombies'.format(**s))
+    (first, last) = (samples[0], samples[-1])
+    leaked = [key for key in ('fds', 'threads', 'zombies')
+              if last[key] > first[key]]
+    if leaked:
+        print('LEAKED: ' + ', '.join(leaked))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()